@@ -2,16 +2,51 @@
 API Test.py
 """
 
+import argparse
 import datetime
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 import requests
-from get_connection import get_connection
-from constants import QUERIES, SCHOOLS
+from get_connection import get_connection, ps_post
+from constants import (
+    QUERIES,
+    SCHOOLS,
+    FETCH_WORKERS,
+    HOST_CONCURRENCY,
+    PAGED_FETCH,
+    PAGE_SIZE,
+    PAGE_WORKERS,
+    DISTRICT_SCHOOLID,
+    DISTRICT_FETCH,
+    SCHOOL_COLUMN,
+    DELTA_WRITES,
+    SNAPSHOT_WRITES,
+)
 from create_service import create_service
-from sheet_functions import update_sheet
+from sheet_functions import update_spreadsheet
+from drive_functions import get_modified_time
+from records import extract_rows
+from manifest import (
+    load_manifest,
+    save_manifest,
+    rows_unchanged,
+    record_rows,
+    record_write,
+)
+from snapshot import open_snapshot, write_rows
+from journal import Journal, JournalBusy, BUSY_EXIT
+from shards import add_arguments, selection, run_name, finish_shard
+from metrics import start_run, stage, carry_labels, write_metrics
 
 
 sheet_service = create_service("sheets", "v4")
+drive_service = create_service("drive", "v3")
+
+# One semaphore per host so the fetch pool never overloads PowerSchool.
+_host_limits = {}
+_host_lock = threading.Lock()
 
 
 def get_current_year_id():
@@ -22,80 +57,502 @@ def get_current_year_id():
     return today.year - 1990
 
 
-def get_ps_api_data(school, year, connection, query):
+def get_ps_api_data(
+    school, year, connection, query, paged=PAGED_FETCH, school_column=None
+):
     """
     Retrieves data from the PowerSchool API.
 
-    This function establishes a connection to the PowerSchool API by calling the `get_connection`
-    function.
-    It then sends a POST request to the specified URL with the required headers and payload.
-    The response from the API is returned.
+    This function sends a POST request to the query URL over the shared PowerSchool session
+    and turns the returned records into rows with `make_list`.
+    When `paged` is True the record count is requested first and the pages are fetched in
+    parallel, each one parsed as it streams in, so no single response holds the whole query.
+
+    Parameters:
+        school (int): The PowerSchool school ID.
+        year (int): The PowerSchool year ID.
+        connection (list): The access token and token type.
+        query (dict): The query entry from QUERIES.
+        paged (bool): Whether to fetch the query a page at a time.
+        school_column (str, optional): A column to append to every row, see `make_list`.
 
     Returns:
-        response: The response object containing the data retrieved from the PowerSchool API.
+        list or None: The rows for the query, or None if any request failed.
     """
 
-    headers = {
-        "Authorization": connection[1] + " " + connection[0],
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
     payload = {
         "schoolid": school,
         "yearid": year,
     }
     try:
-        response = requests.post(
-            query.get("url"), headers=headers, data=json.dumps(payload), timeout=10
-        )
-        return make_list(response.json().get("record"), query)
+        if paged:
+            return get_paged_data(connection, payload, query, school_column)
+        with host_semaphore(query.get("url")):
+            response = ps_post(query.get("url"), connection, payload)
+        return make_list(response.json().get("record"), query, school_column)
     except requests.exceptions.RequestException as error:
         print(f"An error occurred in get_ps_api_data: {error}")
         return None
 
 
-def make_list(record, query):
+def query_base_url(query):
+    """Return the query URL without its query string."""
+    return query.get("url").split("?")[0]
+
+
+def get_record_count(connection, payload, query):
     """
-    Creates a list of data based on the input record.
+    Asks PowerSchool how many records a query will return.
+
+    Parameters:
+        connection (list): The access token and token type.
+        payload (dict): The query arguments.
+        query (dict): The query entry from QUERIES.
+
+    Returns:
+        int: The number of records.
+    """
+    url = query_base_url(query) + "/count"
+    with host_semaphore(url):
+        response = ps_post(url, connection, payload)
+    response.raise_for_status()
+    return response.json().get("count", 0)
+
+
+def get_page(connection, payload, query, page, school_column=None):
+    """
+    Fetches one page of a query and parses its records while they stream in.
+
+    Parameters:
+        connection (list): The access token and token type.
+        payload (dict): The query arguments.
+        query (dict): The query entry from QUERIES.
+        page (int): The 1-based page number.
+        school_column (str, optional): A column to append to every row, see `make_list`.
+
+    Returns:
+        list: The rows on that page.
+    """
+    url = f"{query_base_url(query)}?pagesize={PAGE_SIZE}&page={page}"
+    with host_semaphore(url):
+        with ps_post(url, connection, payload, stream=True) as response:
+            response.raise_for_status()
+            return make_list(iter_records(response), query, school_column)
+
+
+def get_paged_data(connection, payload, query, school_column=None):
+    """
+    Fetches every page of a query in parallel.
 
     Parameters:
-        record (list): The input record containing data.
+        connection (list): The access token and token type.
+        payload (dict): The query arguments.
+        query (dict): The query entry from QUERIES.
+        school_column (str, optional): A column to append to every row, see `make_list`.
 
     Returns:
-        list: A list of processed data.
+        list: The rows for the whole query, in page order.
     """
+    count = get_record_count(connection, payload, query)
+    pages = range(1, -(-count // PAGE_SIZE) + 1)
     data = []
-    if record is not None:
-        for i in record:
-            temp_row = []
-            for col in query.get("columns"):
-                temp_row.append(i.get("tables").get("students").get(col))
-            data.append(temp_row)
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+        fetch_page = carry_labels(get_page)
+        for rows in executor.map(
+            lambda page: fetch_page(connection, payload, query, page, school_column),
+            pages,
+        ):
+            data.extend(rows)
     return data
 
 
-def main():
+def iter_records(response, chunk_size=65536):
+    """
+    Yields the entries of the "record" array of a streamed response one at a time.
+
+    Only the record being decoded and the current chunk are held in memory, rather than
+    the whole response body.
+
+    Parameters:
+        response (requests.Response): A response opened with stream=True.
+        chunk_size (int): The number of bytes to read at a time.
+
+    Yields:
+        dict: One record.
+    """
+    if response.encoding is None:
+        response.encoding = "utf-8"
+    decoder = json.JSONDecoder()
+    buffer = ""
+    in_record = False
+    for chunk in response.iter_content(chunk_size=chunk_size, decode_unicode=True):
+        buffer += chunk
+        if not in_record:
+            start = buffer.find('"record"')
+            bracket = buffer.find("[", start) if start != -1 else -1
+            if bracket == -1:
+                continue
+            buffer = buffer[bracket + 1 :]
+            in_record = True
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == "]":
+                return
+            try:
+                record, pos_end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break
+            yield record
+            pos = pos_end
+        buffer = buffer[pos:]
+
+
+def make_list(record, query, school_column=None):
+    """
+    Creates a list of data based on the input record.
+
+    Parameters:
+        record (iterable): The input records containing data.
+        query (dict): The query entry from QUERIES.
+        school_column (str, optional): If given, the value of this column is appended to
+        the end of every row so `partition_rows` can split the rows by building.
+
+    Returns:
+        list: One tuple per record, see `records.extract_rows`.
+    """
+    columns = query.get("columns")
+    if school_column:
+        columns = columns + [school_column]
+    return extract_rows(record, columns)
+
+
+def partition_rows(rows, schools):
+    """
+    Splits district-wide rows into one list per building in a single pass.
+
+    Every row goes to the district entry, and also to the entry whose school ID matches
+    the school value `make_list` appended to the row. That value is removed from the row.
+
+    Parameters:
+        rows (list): Rows built by `make_list` with a school column.
+        schools (list): The SCHOOLS entries to split into.
+
+    Returns:
+        dict: The rows for each school ID.
+
+    Raises:
+        ValueError: If a row has no school value, or no row belongs to any building,
+        which means the PowerQuery doesn't return SCHOOL_COLUMN. Splitting anyway would
+        leave every building's tabs empty.
+    """
+    buckets = {school.get("schoolid"): [] for school in schools}
+    district = buckets.get(DISTRICT_SCHOOLID)
+    matched = 0
+    for row in rows:
+        schoolid = row[-1]
+        row = row[:-1]
+        if schoolid is None or schoolid == "":
+            raise ValueError(f"a row has no {SCHOOL_COLUMN} value")
+        try:
+            bucket = buckets.get(int(schoolid))
+        except (TypeError, ValueError):
+            bucket = None
+        if bucket is not None and bucket is not district:
+            bucket.append(row)
+            matched += 1
+        if district is not None:
+            district.append(row)
+    if rows and not matched and any(
+        schoolid != DISTRICT_SCHOOLID for schoolid in buckets
+    ):
+        raise ValueError(f"no row's {SCHOOL_COLUMN} matches a building")
+    return buckets
+
+
+def host_semaphore(url):
+    """
+    Returns the semaphore that caps concurrent requests to the host of a URL.
+
+    Parameters:
+        url (str): The URL that is about to be requested.
+
+    Returns:
+        threading.BoundedSemaphore: The semaphore shared by every request to that host.
+    """
+    host = urlparse(url).netloc
+    with _host_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(HOST_CONCURRENCY)
+        return _host_limits[host]
+
+
+def fetch_unit(school, query, year, connection, school_column=None):
+    """
+    Runs a single (school, query) fetch.
+
+    Parameters:
+        school (dict): The school entry from SCHOOLS.
+        query (dict): The query entry from QUERIES.
+        year (int): The PowerSchool year ID.
+        connection (list): The access token and token type.
+        school_column (str, optional): A column to append to every row, see `make_list`.
+
+    Returns:
+        tuple: The school, the query and the list of rows (or None on failure).
+    """
+    with stage("fetch", school.get("schoolid"), query.get("sheetName")):
+        school_info = get_ps_api_data(
+            school.get("schoolid"), year, connection, query, school_column=school_column
+        )
+    return school, query, school_info
+
+
+def write_school(school, results, manifest, journal=None):
+    """
+    Writes the rows of every finished query to the school's spreadsheet in one batch.
+
+    Tabs whose rows are the same as the last ones written are left out, which leaves the
+    spreadsheet untouched when nothing changed so copy_files can skip it as well. That
+    only holds while the spreadsheet's modifiedTime is still the one recorded after the
+    last write: once it was edited by hand, every tab goes through the delta write,
+    which puts back whatever no longer matches the rows.
+
+    Parameters:
+        school (dict): The school entry from SCHOOLS.
+        results (list): The (query, rows) pairs for the school.
+        manifest (dict): The change manifest.
+        journal (Journal, optional): The run journal each written tab is recorded in.
+    """
+    with stage("write", school.get("schoolid")):
+        ssid = school.get("ssid")
+        modified_time = get_modified_time(drive_service, ssid)
+        changed = []
+        for query, rows in results:
+            if rows_unchanged(
+                manifest, ssid, query.get("sheetName"), rows, modified_time
+            ):
+                print(f"{query.get('sheetName')} unchanged, skipping write.")
+                if journal is not None:
+                    journal.record(school.get("schoolid"), query.get("sheetName"))
+            else:
+                changed.append((query, rows))
+        if not changed:
+            return
+        tabs = [
+            {
+                "sheetName": query.get("sheetName"),
+                "values": rows,
+                "columns": query.get("columns"),
+                "keyColumns": query.get("keyColumns") if DELTA_WRITES else None,
+            }
+            for query, rows in changed
+        ]
+        if update_spreadsheet(sheet_service, ssid, tabs, False):
+            record_write(manifest, ssid, get_modified_time(drive_service, ssid))
+            for query, rows in changed:
+                record_rows(manifest, ssid, query.get("sheetName"), rows)
+                if journal is not None:
+                    journal.record(school.get("schoolid"), query.get("sheetName"))
+
+
+def write_all(
+    schools,
+    queries,
+    manifest,
+    journal,
+    workers=FETCH_WORKERS,
+    district=DISTRICT_FETCH,
+    snapshot=SNAPSHOT_WRITES,
+    after_write=None,
+):
+    """
+    Fetches the queries and writes every school's spreadsheet, the work of `main`.
+
+    Parameters:
+        schools (list): The SCHOOLS entries to write.
+        queries (list): The QUERIES entries to run.
+        manifest (dict): The change manifest.
+        journal (Journal): The run journal. Pairs it already has are skipped.
+        workers (int): The number of fetches to run at the same time.
+        district (bool): Whether to fetch at district scope and partition locally.
+        snapshot (bool): Whether to write the rows to the local snapshot.
+        after_write (function, optional): Called on the writer thread with each school
+        and its (query, rows) pairs once its spreadsheet is written, or with an empty
+        list if this run had nothing to write for it. Every school gets one call.
+
+    Returns:
+        bool: True if every (school, query) pair is in the journal.
+    """
+    connection = get_connection()
+    year = get_current_year_id()
+    todo = {
+        school.get("ssid"): [
+            query
+            for query in queries
+            if not journal.done(school.get("schoolid"), query.get("sheetName"))
+        ]
+        for school in schools
+    }
+    if district:
+        units = [
+            (school, query)
+            for school in SCHOOLS
+            if school.get("schoolid") == DISTRICT_SCHOOLID
+            for query in queries
+            if any(query in needed for needed in todo.values())
+        ]
+        school_column = SCHOOL_COLUMN
+        snapshot = snapshot and any(
+            school.get("schoolid") == DISTRICT_SCHOOLID for school in schools
+        )
+    else:
+        units = [
+            (school, query) for school in schools for query in todo[school.get("ssid")]
+        ]
+        school_column = None
+    pending = {school.get("ssid"): [] for school in schools}
+    remaining = {ssid: len(needed) for ssid, needed in todo.items()}
+    database = open_snapshot() if snapshot else None
+
+    def finish_school(school, results):
+        if results:
+            write_school(school, results, manifest, journal)
+        if after_write is not None:
+            after_write(school, results)
+
+    # The Sheets service is not thread safe, so all writes go through one thread. The
+    # snapshot database gets its own thread for the same reason.
+    with ThreadPoolExecutor(max_workers=1) as writer, ThreadPoolExecutor(
+        max_workers=1
+    ) as snapshotter, ThreadPoolExecutor(max_workers=workers) as fetcher:
+        writes = [
+            writer.submit(finish_school, school, [])
+            for school in schools
+            if after_write is not None and not todo[school.get("ssid")]
+        ]
+        fetches = [
+            fetcher.submit(fetch_unit, school, query, year, connection, school_column)
+            for school, query in units
+        ]
+        for future in as_completed(fetches):
+            school, query, school_info = future.result()
+            if district:
+                try:
+                    buckets = partition_rows(school_info or [], SCHOOLS)
+                except ValueError as error:
+                    # The query is failed for every school rather than written with
+                    # the buildings' rows missing.
+                    print(
+                        f"An error occurred in partition_rows for "
+                        f"{query.get('sheetName')}: {error}"
+                    )
+                    buckets, school_info = {}, None
+                results = [
+                    (target, buckets.get(target.get("schoolid")))
+                    for target in schools
+                    if query in todo[target.get("ssid")]
+                ]
+            else:
+                results = [(school, school_info)]
+            # District rows are only snapshotted once they were split cleanly, so a
+            # query that failed to split leaves the snapshot as it was, like the sheets.
+            if database is not None and school_info is not None:
+                if district:
+                    snapshotter.submit(write_rows, database, query, school_info)
+                elif school.get("schoolid") != DISTRICT_SCHOOLID:
+                    # The district pull repeats the buildings' rows without saying
+                    # which building each belongs to, so only buildings are kept.
+                    snapshotter.submit(
+                        write_rows, database, query, school_info, school.get("schoolid")
+                    )
+            for target, rows in results:
+                ssid = target.get("ssid")
+                if rows:
+                    pending[ssid].append((query, rows))
+                elif school_info is not None:
+                    # Nothing to write, but the fetch worked, so the pair is finished.
+                    journal.record(target.get("schoolid"), query.get("sheetName"))
+                remaining[ssid] -= 1
+                if remaining[ssid] == 0 and (pending[ssid] or after_write is not None):
+                    writes.append(
+                        writer.submit(finish_school, target, pending.pop(ssid))
+                    )
+        for future in writes:
+            future.result()
+    if database is not None:
+        database.close()
+    return all(
+        journal.done(school.get("schoolid"), query.get("sheetName"))
+        for school in schools
+        for query in queries
+    )
+
+
+def main(
+    workers=FETCH_WORKERS,
+    district=DISTRICT_FETCH,
+    snapshot=SNAPSHOT_WRITES,
+    resume=False,
+    schools=SCHOOLS,
+    queries=QUERIES,
+    shard=None,
+):
     """
     This function retrieves school information using the PowerSchool API and updates
     the respective sheet.
-    No parameters or return types specified.
+
+    Every (school, query) pair is fetched on a pool of `workers` threads. Once all the
+    queries for a school have finished, its tabs are handed to a single writer thread
+    that writes them in one batch, so the Sheets writes run as their own stage and the
+    run takes about as long as the slowest query.
+    When `district` is True each query is only fetched once for the district and the
+    rows are split by building locally.
+    When `snapshot` is True the rows are also written to the local SQLite snapshot, on a
+    thread of its own, so staff can look students up while Google is unreachable.
+    Every (school, query) that is written is recorded in the run journal. When `resume`
+    is True the pairs the last run finished are skipped, and a query is only fetched if
+    a school still needs it.
+    Only `schools` and `queries` are worked on, so a run can be narrowed down or split
+    across workers with `shards.select_schools`. In district mode every worker fetches
+    the district rows, and only the one with the district school keeps the snapshot.
+
+    Parameters:
+        workers (int): The number of fetches to run at the same time.
+        district (bool): Whether to fetch at district scope and partition locally.
+        snapshot (bool): Whether to write the rows to the local snapshot.
+        resume (bool): Whether to pick up where the last, unfinished run stopped.
+        schools (list): The SCHOOLS entries to write.
+        queries (list): The QUERIES entries to run.
+        shard (tuple, optional): The shard number and count, which name the run's
+        journal and metrics.
     """
-    connection = get_connection()
-    for school in SCHOOLS:
-        for query in QUERIES:
-            school_info = get_ps_api_data(
-                school.get("schoolid"), get_current_year_id(), connection, query
-            )
-            if school_info:
-                update_sheet(
-                    sheet_service,
-                    school.get("ssid"),
-                    query.get("sheetName"),
-                    school_info,
-                    query.get("columns"),
-                    False,
-                )
+    start_run()
+    name = run_name("api_writer", shard)
+    with Journal(name, resume) as journal:
+        manifest = load_manifest()
+        complete = write_all(
+            schools, queries, manifest, journal, workers, district, snapshot
+        )
+        save_manifest(manifest)
+        journal.finish(complete)
+    finish_shard("api_writer", shard, complete)
+    write_metrics(name)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Back up PowerQueries to Sheets.")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the schools and queries the last, unfinished run already wrote.",
+    )
+    add_arguments(parser, queries=True)
+    args = parser.parse_args()
+    try:
+        main(resume=args.resume, **selection(parser, args, "api_writer"))
+    except JournalBusy as error:
+        parser.exit(BUSY_EXIT, f"{error}\n")
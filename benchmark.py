@@ -0,0 +1,210 @@
+"""
+This module runs api_writer and copy_files end to end against the local stand-ins in
+fake_services.py and reports how each run performed.
+
+Every phase runs in its own process in a scratch directory, the way the scripts run for
+real, so module caches, the manifest and memory use start out the same each time. For
+each phase it reports the wall time, the peak memory of the process and of the render
+processes it started, and the calls and bytes for every endpoint, including the errors
+and 429s the stand-ins injected.
+
+Example:
+    python benchmark.py --students 5000 --google-latency 0.05 --throttle-rate 0.02
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from fake_services import FakePowerSchool, FakeGoogle
+
+# The scripts each run executes, in order.
+PHASES = ("api_writer", "copy_files")
+
+# Marks the line a phase process prints its own measurements on.
+RESULT_MARKER = "BENCHMARK_RESULT "
+
+
+def stand_in_env(services):
+    """
+    Returns an environment that points the scripts at the stand-ins.
+
+    Args:
+        services (dict): The running stand-ins, with "powerschool" and "google" keys.
+
+    Returns:
+        dict: A copy of the current environment with the stand-ins' URLs and
+        credentials set.
+    """
+    return dict(
+        os.environ,
+        PS_BASE_URL=services["powerschool"].url.rstrip("/"),
+        GOOGLE_API_ENDPOINT=services["google"].url,
+        PS_API_ID="benchmark",
+        PS_API_SECRET="benchmark",
+    )
+
+
+def run_phase(name):
+    """
+    Runs the main function of one script and prints its time and peak memory.
+
+    This runs in the phase process, which benchmark_phase starts with the environment
+    pointing at the stand-ins.
+
+    Args:
+        name (str): The module to run, one of PHASES.
+    """
+    start = time.perf_counter()
+    module = __import__(name)
+    module.main()
+    seconds = time.perf_counter() - start
+    result = {
+        "seconds": seconds,
+        # ru_maxrss is in KiB on Linux.
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children_max_rss_kb": resource.getrusage(
+            resource.RUSAGE_CHILDREN
+        ).ru_maxrss,
+    }
+    print(RESULT_MARKER + json.dumps(result))
+
+
+def benchmark_phase(name, workdir, env, services):
+    """
+    Runs one phase in its own process and collects what it measured.
+
+    Args:
+        name (str): The module to run, one of PHASES.
+        workdir (str): The scratch directory the phase runs in.
+        env (dict): The environment for the phase process.
+        services (dict): The stand-ins, keyed by the name used in the report.
+
+    Returns:
+        dict: The phase's measurements and the stand-ins' counts for it.
+    """
+    for service in services.values():
+        service.take_stats()
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--phase", name],
+        cwd=workdir,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    wall = time.perf_counter() - start
+    with open(os.path.join(workdir, name + ".log"), "a", encoding="utf-8") as log:
+        log.write(completed.stdout)
+        log.write(completed.stderr)
+    result = {"phase": name, "ok": completed.returncode == 0, "wall_seconds": wall}
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            result.update(json.loads(line[len(RESULT_MARKER) :]))
+    if not result["ok"]:
+        result["error"] = completed.stderr.strip().splitlines()[-1:]
+    result["endpoints"] = {
+        service_name: service.take_stats()
+        for service_name, service in services.items()
+    }
+    return result
+
+
+def print_result(result, run):
+    """Print the report for one phase."""
+    status = "" if result["ok"] else f"  FAILED: {result.get('error')}"
+    seconds = result.get("seconds", result["wall_seconds"])
+    print(
+        f"{result['phase']} (run {run}): {seconds:.2f}s, "
+        f"peak RSS {result.get('max_rss_kb', 0) / 1024:.1f} MiB, "
+        f"render processes {result.get('children_max_rss_kb', 0) / 1024:.1f} MiB"
+        f"{status}"
+    )
+    totals = {"calls": 0, "bytes_in": 0, "bytes_out": 0}
+    for service_name, endpoints in result["endpoints"].items():
+        for endpoint, stats in sorted(endpoints.items()):
+            for field in totals:
+                totals[field] += stats[field]
+            faults = ""
+            if stats["errors"] or stats["throttled"]:
+                faults = f"  ({stats['errors']} errors, {stats['throttled']} throttled)"
+            print(
+                f"  {service_name:<11} {endpoint:<20} {stats['calls']:>6} calls "
+                f"{stats['bytes_in'] / 1024:>10.1f} KiB in "
+                f"{stats['bytes_out'] / 1024:>10.1f} KiB out{faults}"
+            )
+    print(
+        f"  {'total':<32} {totals['calls']:>6} calls "
+        f"{totals['bytes_in'] / 1024:>10.1f} KiB in "
+        f"{totals['bytes_out'] / 1024:>10.1f} KiB out"
+    )
+
+
+def main():
+    """Start the stand-ins, run every phase and report the results."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--phase", choices=PHASES, help=argparse.SUPPRESS)
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--runs", type=int, default=2, help="Runs in the same state.")
+    parser.add_argument(
+        "--churn", type=float, default=0.01, help="Share of records changed per run."
+    )
+    parser.add_argument("--ps-latency", type=float, default=0.0, help="Seconds.")
+    parser.add_argument("--google-latency", type=float, default=0.0, help="Seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file.")
+    parser.add_argument(
+        "--workdir", help="Run in this directory and keep its logs and state."
+    )
+    args = parser.parse_args()
+
+    if args.phase:
+        run_phase(args.phase)
+        return
+
+    faults = {
+        "error_rate": args.error_rate,
+        "throttle_rate": args.throttle_rate,
+        "seed": args.seed,
+    }
+    services = {
+        "powerschool": FakePowerSchool(
+            students=args.students, latency=args.ps_latency, **faults
+        ).start(),
+        "google": FakeGoogle(latency=args.google_latency, **faults).start(),
+    }
+    env = stand_in_env(services)
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        workspace = contextlib.nullcontext(args.workdir)
+    else:
+        workspace = tempfile.TemporaryDirectory(prefix="ps-benchmark-")
+    results = []
+    try:
+        with workspace as workdir:
+            for run in range(1, args.runs + 1):
+                if run > 1:
+                    services["powerschool"].advance(args.churn)
+                for phase in PHASES:
+                    result = benchmark_phase(phase, workdir, env, services)
+                    result["run"] = run
+                    print_result(result, run)
+                    results.append(result)
+    finally:
+        for service in services.values():
+            service.stop()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({"settings": vars(args), "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,22 @@ This module contains constants used in the PowerSchool API interaction.
 It includes a list of queries, schools, and file formats.
 """
 
-AUTH_URL = "https://min201.powerschool.com/oauth/access_token"
+import os
+
+# The PowerSchool server. Set PS_BASE_URL to point the scripts at another server, such
+# as the stand-ins in fake_services.py.
+PS_BASE_URL = os.environ.get("PS_BASE_URL", "https://min201.powerschool.com")
+
+# The root URL for the Google APIs. None uses Google; set GOOGLE_API_ENDPOINT to point
+# the scripts at another server, such as the stand-ins in fake_services.py.
+GOOGLE_API_ENDPOINT = os.environ.get("GOOGLE_API_ENDPOINT")
+
+AUTH_URL = PS_BASE_URL + "/oauth/access_token"
 
 QUERIES = [
     {
         "sheetName": "Transportation Info",
-        "url": "https://min201.powerschool.com/ws/schema/query/org.d201.students.transport_info_per_building?pagesize=0",
+        "url": PS_BASE_URL + "/ws/schema/query/org.d201.students.transport_info_per_building?pagesize=0",
         "columns": [
             "student_number",
             "lastfirst",
@@ -33,10 +43,11 @@ QUERIES = [
             "daycare_after_phone",
             "daycare_arrangements",
         ],
+        "keyColumns": ["student_number"],
     },
     {
         "sheetName": "Schedule Info",
-        "url": "https://min201.powerschool.com/ws/schema/query/org.d201.students.student_schedule_per_building?pagesize=0",
+        "url": PS_BASE_URL + "/ws/schema/query/org.d201.students.student_schedule_per_building?pagesize=0",
         "columns": [
             "student_number",
             "lastfirst",
@@ -48,10 +59,11 @@ QUERIES = [
             "period_number",
             "time",
         ],
+        "keyColumns": ["student_number", "period_number", "course_name", "teacher"],
     },
     {
         "sheetName": "Contact Info",
-        "url": "https://min201.powerschool.com/ws/schema/query/org.d201.students.student_contacts_per_building?pagesize=0",
+        "url": PS_BASE_URL + "/ws/schema/query/org.d201.students.student_contacts_per_building?pagesize=0",
         "columns": [
             "student_number",
             "lastfirst",
@@ -65,6 +77,7 @@ QUERIES = [
             "contphone",
             "contemail",
         ],
+        "keyColumns": ["student_number", "contname", "contrel"],
     },
 ]
 
@@ -127,3 +140,145 @@ FILE_FORMATS = [
         "name": ".pdf",
     },
 ]
+
+# Number of (school, query) fetches api_writer runs at the same time.
+FETCH_WORKERS = 6
+
+# Most requests allowed in flight against a single host at once.
+HOST_CONCURRENCY = 4
+
+# Fetch PowerQueries a page at a time instead of in one pagesize=0 response.
+PAGED_FETCH = True
+
+# Records requested per PowerQuery page.
+PAGE_SIZE = 1000
+
+# Number of pages of a single query fetched at the same time.
+PAGE_WORKERS = 4
+
+# The SCHOOLS entry whose query returns data for the whole district.
+DISTRICT_SCHOOLID = 0
+
+# Run each query once at district scope and split the rows by building locally.
+# Off until every PowerQuery returns SCHOOL_COLUMN, since the split needs it.
+DISTRICT_FETCH = False
+
+# The PowerQuery column holding a record's building, used to split district rows.
+SCHOOL_COLUMN = "schoolid"
+
+# Only write the rows that changed instead of clearing and rewriting every tab.
+DELTA_WRITES = True
+
+# Where the change manifest shared by api_writer and copy_files is kept between runs.
+MANIFEST_FILE = "manifest.json"
+
+# Where each script's run journal is kept, for --resume. {} is the script name.
+JOURNAL_FILE = "{}_journal.jsonl"
+
+# Where the split of each script's schools across shards is kept until every shard has
+# finished with it. {} is the script name.
+SHARD_PLAN_FILE = "{}_shards.json"
+
+
+# Number of uploads of one export to destination folders run at the same time.
+UPLOAD_WORKERS = 4
+
+# Bytes fetched per request when downloading an export.
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Bytes sent per request when uploading an export. Must be a multiple of 256 KiB.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Exports bigger than this are moved from memory to a temporary file while downloading.
+SPOOL_LIMIT = 32 * 1024 * 1024
+
+# Total memory all exports in flight may hold at once. An export that doesn't fit in
+# what is left of it moves to a temporary file, like one bigger than SPOOL_LIMIT does.
+# Up to EXPORT_WORKERS exports are held at once, so the budget only binds when it is
+# below EXPORT_WORKERS * SPOOL_LIMIT.
+EXPORT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Number of exports downloaded and uploaded at the same time.
+EXPORT_WORKERS = 3
+
+# Number of single-tab PDFs rendered at the same time.
+PDF_WORKERS = 3
+
+# Build XLSX and PDF files locally from the sheet rows instead of exporting them from
+# Drive. Drive export is still used if rendering fails.
+LOCAL_RENDER = True
+
+# Number of processes rendering files. None uses one per CPU core.
+RENDER_WORKERS = None
+
+# Where the PowerSchool access token is cached between runs when keyring can't hold it.
+PS_TOKEN_FILE = "ps_token.json"
+
+# Seconds before the PowerSchool token expires that it is treated as expired.
+TOKEN_REFRESH_MARGIN = 300
+
+# Sheets API requests allowed per minute for reads and for writes (per-user quota).
+SHEETS_READS_PER_MINUTE = 60
+SHEETS_WRITES_PER_MINUTE = 60
+
+# Drive API requests allowed per minute.
+DRIVE_REQUESTS_PER_MINUTE = 1000
+
+# Most Google requests in flight per API. Lowered automatically when 429s come back.
+GOOGLE_MAX_CONCURRENCY = 8
+
+# Attempts made for a Google request before giving up.
+GOOGLE_MAX_ATTEMPTS = 6
+
+# First and longest backoff between attempts, in seconds.
+BACKOFF_BASE = 1
+BACKOFF_MAX = 64
+
+# Estimated bytes of cell data sent per values.batchUpdate. Larger writes are split into
+# blocks of about this size.
+WRITE_BLOCK_BYTES = 2 * 1024 * 1024
+
+# Number of blocks written at the same time, across every spreadsheet being written.
+WRITE_WORKERS = 4
+
+# Also keep each run's rows in a local SQLite database for lookups during an outage.
+SNAPSHOT_WRITES = True
+
+# Where the local snapshot database is kept.
+SNAPSHOT_FILE = "snapshot.db"
+
+# The columns each kind of snapshot lookup searches. Every one of them that a query
+# returns is indexed, along with the building column.
+SNAPSHOT_LOOKUPS = {
+    "student": ["student_number", "lastfirst"],
+    "bus": ["pickup_bus", "dropoff_bus"],
+    "room": ["room", "home_room"],
+}
+
+# Where each run's JSON metrics summary and Prometheus textfile are written.
+METRICS_DIR = "metrics"
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Where stress_test_runner keeps the duration percentiles later runs are compared to.
+STRESS_BASELINE_FILE = "stress_baseline.json"
+
+# How much worse, as a fraction, a stress test percentile may get before it is flagged.
+STRESS_REGRESSION_THRESHOLD = 0.2
+
+# Days of the week the daemon runs on, Monday being 0.
+DAEMON_DAYS = (0, 1, 2, 3, 4)
+
+# The first and last times of day, as HH:MM, the daemon starts a cycle.
+DAEMON_START = "06:00"
+DAEMON_END = "17:00"
+
+# Minutes between the starts of the daemon's cycles, counted from DAEMON_START.
+DAEMON_INTERVAL = 60
+
+# Seconds that spreadsheet metadata stays cached before it is fetched again. It outlasts
+# the gap between daemon cycles, so each cycle starts with the tabs the last one saw.
+# Changes the scripts make, and failed updates, drop the cached metadata themselves, so
+# this only bounds how long a tab added or renamed by hand can go unnoticed.
+METADATA_TTL = 2 * DAEMON_INTERVAL * 60
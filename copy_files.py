@@ -2,24 +2,515 @@
 This module contains functions for interacting with Google Sheets and Google Drive APIs.
 """
 
+import argparse
+import os
 import socket
-from constants import SCHOOLS, QUERIES, FILE_FORMATS
-from create_service import create_service
+from constants import (
+    SCHOOLS,
+    QUERIES,
+    FILE_FORMATS,
+    DELTA_WRITES,
+    UPLOAD_WORKERS,
+    EXPORT_WORKERS,
+    LOCAL_RENDER,
+    RENDER_WORKERS,
+)
+from create_service import create_service, thread_service, worker_pool, process_pool
 from sheet_functions import (
     get_sheets,
     get_ss_name,
-    read_sheet,
-    update_sheet,
+    batch_get_values,
+    update_spreadsheet,
     copy_spreadsheet,
 )
-from drive_functions import find_file, export_file
+from drive_functions import (
+    find_file,
+    download_export,
+    upload_export,
+    get_modified_time,
+    SpillBuffer,
+)
+from render_functions import render_xlsx, render_pdf
+from manifest import load_manifest, save_manifest, push_unchanged, record_push
+from metrics import start_run, stage, carry_labels, write_metrics
+from journal import Journal, JournalBusy, BUSY_EXIT
+from shards import add_arguments, selection, run_name, finish_shard
 
 socket.setdefaulttimeout(600)
 sheets_service = create_service("sheets", "v4")
 drive_service = create_service("drive", "v3")
 
+# The columns and key columns of each tab, keyed by sheet name.
+QUERY_COLUMNS = {query.get("sheetName"): query.get("columns") for query in QUERIES}
+QUERY_KEYS = {query.get("sheetName"): query.get("keyColumns") for query in QUERIES}
+
+
+def estimated_calls(file_format, tab_count):
+    """
+    Returns roughly how many API calls pushing one format to one folder costs.
+
+    Args:
+        file_format (dict): The entry from FILE_FORMATS.
+        tab_count (int): The number of tabs in the source spreadsheet.
+
+    Returns:
+        int: The estimated number of calls, not counting the shared exports.
+    """
+    if file_format.get("name") == "sheet":
+        # The mirror's batched read and writes.
+        return 3
+    if file_format.get("name") == ".pdf":
+        # One upload for each tab.
+        return tab_count
+    return 1
+
+
+def estimated_exports(file_format, tab_count):
+    """Return how many exports one format costs for a spreadsheet."""
+    if file_format.get("name") == ".pdf":
+        return tab_count
+    return 1
+
+
+def export_files(ss_name, sheets, file_format):
+    """
+    Returns the files one format produces in each folder.
+
+    Args:
+        ss_name (str): The name of the source spreadsheet.
+        sheets (dict): The spreadsheet metadata from get_sheets.
+        file_format (dict): The entry from FILE_FORMATS.
+
+    Returns:
+        list: (file name, sheetId) pairs. The sheetId is the tab to render, or None for
+        the whole spreadsheet.
+    """
+    # if pdf then save name with sheetname and .pdf, one file per tab
+    if file_format.get("name") == ".pdf":
+        return [
+            (
+                ss_name
+                + " - "
+                + sheet.get("properties").get("title")
+                + file_format.get("name"),
+                sheet.get("properties").get("sheetId"),
+            )
+            for sheet in sheets.get("sheets")
+        ]
+    # if xlsx then save name with .xlsx
+    return [(ss_name + file_format.get("name"), None)]
+
 
-def main():
+def file_unit(schoolid, folder, format_name, sheet_id, modified_time):
+    """
+    Returns the journal unit for one file in one folder.
+
+    The source's modifiedTime is part of the unit, so a resumed run only skips files
+    that already hold the version it is pushing.
+
+    Args:
+        schoolid (int): The school the source spreadsheet belongs to.
+        folder (str): The ID of the destination folder.
+        format_name (str): The name of the file format.
+        sheet_id (int or None): The tab the file holds, or None for every tab.
+        modified_time (str or None): The source's Drive modifiedTime.
+
+    Returns:
+        tuple: The parts of the unit.
+    """
+    tab = "all" if sheet_id is None else sheet_id
+    return (schoolid, folder, format_name, tab, modified_time)
+
+
+def read_tabs(ssid, sheets, fresh=None):
+    """
+    Reads every tab of a source spreadsheet with one values.batchGet.
+
+    Args:
+        ssid (str): The ID of the source spreadsheet.
+        sheets (dict): The spreadsheet metadata from get_sheets.
+        fresh (dict, optional): Values already in memory, keyed by sheet name, such as
+        the rows the pipeline just wrote. Only the other tabs are read.
+
+    Returns:
+        list or None: One tab dict per sheet, as taken by update_spreadsheet, or None if
+        the read failed.
+    """
+    sheet_names = [
+        sheet.get("properties").get("title") for sheet in sheets.get("sheets")
+    ]
+    values = dict(fresh or {})
+    missing = [sheet_name for sheet_name in sheet_names if sheet_name not in values]
+    if missing:
+        with stage("read"):
+            ranges = batch_get_values(
+                sheets_service, ssid, [f"'{sheet_name}'" for sheet_name in missing]
+            )
+        if ranges is None:
+            return None
+        values.update(zip(missing, ranges))
+    return [
+        {
+            "sheetName": sheet_name,
+            "values": values[sheet_name],
+            "columns": QUERY_COLUMNS.get(sheet_name),
+            "keyColumns": QUERY_KEYS.get(sheet_name) if DELTA_WRITES else None,
+        }
+        for sheet_name in sheet_names
+    ]
+
+
+def mirror_sheet(ssid, ss_name, tabs, folder):
+    """
+    Copies the values of every tab of a spreadsheet to its mirror in a folder.
+
+    If the folder doesn't have a mirror yet, the spreadsheet is copied there instead.
+
+    Args:
+        ssid (str): The ID of the source spreadsheet.
+        ss_name (str): The name of the source spreadsheet.
+        tabs (list): The source tabs from read_tabs.
+        folder (str): The ID of the destination folder.
+
+    Returns:
+        bool: True if the mirror was updated or created.
+    """
+    with stage("mirror", item="sheet"):
+        existing_file = find_file(drive_service, ss_name, folder)
+        if not existing_file:
+            return copy_spreadsheet(ssid, ss_name, drive_service, folder) is not None
+        return update_spreadsheet(sheets_service, existing_file.get("id"), tabs, True)
+
+
+def upload_to_folder(content, mime_type, file_name, folder):
+    """
+    Uploads an export to a file in a folder, run on an upload worker thread.
+
+    Args:
+        content (bytes): The exported content.
+        mime_type (str): The MIME type of the content.
+        file_name (str): The name of the file.
+        folder (str): The ID of the destination folder.
+
+    Returns:
+        bool: True if the upload succeeded.
+    """
+    with stage("upload"):
+        service = thread_service("drive", "v3")
+        existing_file = find_file(service, file_name, folder)
+        file_id = upload_export(
+            service,
+            content,
+            mime_type,
+            file_name,
+            folder,
+            existing_file.get("id") if existing_file else None,
+        )
+    return file_id is not None
+
+
+def render_file(renderer, tabs, file_format, file_name, sheet_id, sheets):
+    """
+    Starts rendering a file locally from the source tabs.
+
+    Args:
+        renderer (ProcessPoolExecutor): The pool the rendering runs on.
+        tabs (list): The source tabs from read_tabs.
+        file_format (dict): The entry from FILE_FORMATS.
+        file_name (str): The name of the file, used as the PDF title.
+        sheet_id (int or None): The sheetId of the tab to render, or None for all tabs.
+        sheets (dict): The spreadsheet metadata from get_sheets.
+
+    Returns:
+        Future: A future for the file's bytes.
+    """
+    if file_format.get("name") == ".pdf":
+        sheet_name = next(
+            sheet.get("properties").get("title")
+            for sheet in sheets.get("sheets")
+            if sheet.get("properties").get("sheetId") == sheet_id
+        )
+        values = next(
+            tab.get("values") for tab in tabs if tab.get("sheetName") == sheet_name
+        )
+        return renderer.submit(render_pdf, os.path.splitext(file_name)[0], values)
+    return renderer.submit(
+        render_xlsx, [(tab.get("sheetName"), tab.get("values")) for tab in tabs]
+    )
+
+
+def rendered_content(render):
+    """
+    Waits for a local render and wraps its bytes for uploading.
+
+    Args:
+        render (Future): The future from render_file.
+
+    Returns:
+        SpillBuffer or None: The rendered content, or None if rendering failed.
+    """
+    try:
+        data = render.result()
+    except Exception as error:  # pylint: disable=broad-except
+        print(f"An error occurred rendering locally, exporting from Drive: {error}")
+        return None
+    content = SpillBuffer()
+    content.write(data)
+    content.finish()
+    return content
+
+
+def export_to_folders(
+    uploader,
+    ssid,
+    file_format,
+    file_name,
+    sheet_id,
+    folders,
+    render=None,
+    journal=None,
+    source=None,
+):
+    """
+    Exports a spreadsheet, or one of its tabs, once and uploads it to every folder.
+
+    Runs on an export worker thread. The export is held in memory only while it fits in
+    what is left of EXPORT_MEMORY_BUDGET, and goes to a temporary file otherwise. If the
+    file is being rendered locally that render is used, and Drive is only asked for an
+    export if it fails.
+
+    Args:
+        uploader (ThreadPoolExecutor): The pool the uploads run on.
+        ssid (str): The ID of the source spreadsheet.
+        file_format (dict): The entry from FILE_FORMATS.
+        file_name (str): The name of the file in each folder.
+        sheet_id (int or None): The sheetId of the tab to export, or None for all tabs.
+        folders (list): The IDs of the destination folders.
+        render (Future, optional): The local render of the file from render_file.
+        journal (Journal, optional): The run journal finished uploads are recorded in.
+        source (tuple, optional): The school and modifiedTime of the spreadsheet, for
+        the journal.
+
+    Returns:
+        list: The folders where the upload succeeded.
+    """
+    with stage("export", item=file_format.get("name")):
+        content = rendered_content(render) if render is not None else None
+        if content is None:
+            content = download_export(
+                thread_service("drive", "v3"),
+                ssid,
+                file_format.get("mimeType"),
+                sheet_id,
+            )
+    if content is None:
+        return []
+    try:
+        uploads = {
+            folder: uploader.submit(
+                carry_labels(upload_to_folder),
+                content,
+                file_format.get("mimeType"),
+                file_name,
+                folder,
+            )
+            for folder in folders
+        }
+        uploaded = [folder for folder, future in uploads.items() if future.result()]
+        if journal is not None:
+            schoolid, modified_time = source
+            for folder in uploaded:
+                journal.record(
+                    *file_unit(
+                        schoolid,
+                        folder,
+                        file_format.get("name"),
+                        sheet_id,
+                        modified_time,
+                    )
+                )
+        return uploaded
+    finally:
+        content.discard()
+
+
+class CopyRun:
+    """
+    Copies spreadsheets to their schools' folders, one school at a time.
+
+    The exports of every school share one set of worker pools, so a school's files are
+    still being exported and uploaded while the next school is handled.
+    """
+
+    def __init__(self, manifest, journal, formats=FILE_FORMATS):
+        """
+        Sets up the worker pools.
+
+        Args:
+            manifest (dict): The change manifest.
+            journal (Journal): The run journal. Files it already has are skipped.
+            formats (list): The FILE_FORMATS entries to copy to.
+        """
+        self.manifest = manifest
+        self.journal = journal
+        self.formats = formats
+        self.complete = True
+        self.skipped_exports = 0
+        self.skipped_calls = 0
+        self.exports = []
+        # The export and upload workers keep their Drive services between runs, and the
+        # render processes are only started once.
+        self.exporter = worker_pool("export", EXPORT_WORKERS)
+        self.uploader = worker_pool("upload", UPLOAD_WORKERS)
+        self.renderer = process_pool("render", RENDER_WORKERS) if LOCAL_RENDER else None
+
+    def copy_school(self, school, fresh=None):
+        """
+        Pushes a school's spreadsheet to every folder and format that needs it.
+
+        Mirrors are written before this returns. Exports are started in the background
+        and waited for by `finish`.
+
+        Args:
+            school (dict): The school entry from SCHOOLS.
+            fresh (dict, optional): Tab values already in memory, keyed by sheet name,
+            which are used instead of reading those tabs back.
+        """
+        manifest, journal, renderer = self.manifest, self.journal, self.renderer
+        with stage("school", school.get("schoolid")):
+            schoolid = school.get("schoolid")
+            ssid = school.get("ssid")
+            ss_name = get_ss_name(sheets_service, ssid)
+            sheets = get_sheets(sheets_service, ssid)
+            modified_time = get_modified_time(drive_service, ssid)
+            tab_count = len(sheets.get("sheets"))
+            tabs = None
+            for file_format in self.formats:
+                format_name = file_format.get("name")
+                if format_name == ".pdf" and schoolid == 0:
+                    continue
+                folders = []
+                for folder in school.get("folders"):
+                    if push_unchanged(
+                        manifest, ssid, folder, format_name, modified_time
+                    ):
+                        self.skipped_calls += estimated_calls(file_format, tab_count)
+                    else:
+                        folders.append(folder)
+                if not folders:
+                    if format_name != "sheet":
+                        skipped = estimated_exports(file_format, tab_count)
+                        self.skipped_exports += skipped
+                        self.skipped_calls += skipped
+                    continue
+                if format_name == "sheet":
+                    units = {
+                        folder: file_unit(
+                            schoolid, folder, format_name, None, modified_time
+                        )
+                        for folder in folders
+                    }
+                    if tabs is None and any(
+                        not journal.done(*unit) for unit in units.values()
+                    ):
+                        tabs = read_tabs(ssid, sheets, fresh)
+                    for folder, unit in units.items():
+                        if not journal.done(*unit) and tabs is not None:
+                            if mirror_sheet(ssid, ss_name, tabs, folder):
+                                journal.record(*unit)
+                        if journal.done(*unit):
+                            record_push(
+                                manifest, ssid, folder, format_name, modified_time
+                            )
+                        else:
+                            self.complete = False
+                    continue
+
+                # Files the run being resumed already pushed are left out.
+                sheet_ids = []
+                files = []
+                for file_name, sheet_id in export_files(ss_name, sheets, file_format):
+                    sheet_ids.append(sheet_id)
+                    todo = [
+                        folder
+                        for folder in folders
+                        if not journal.done(
+                            *file_unit(
+                                schoolid, folder, format_name, sheet_id, modified_time
+                            )
+                        )
+                    ]
+                    if todo:
+                        files.append((file_name, sheet_id, todo))
+                if files and tabs is None and renderer is not None:
+                    tabs = read_tabs(ssid, sheets, fresh)
+
+                # Build each file once, then send the same bytes to every folder.
+                futures = []
+                for file_name, sheet_id, file_folders in files:
+                    render = None
+                    if renderer is not None and tabs is not None:
+                        render = render_file(
+                            renderer, tabs, file_format, file_name, sheet_id, sheets
+                        )
+                    futures.append(
+                        self.exporter.submit(
+                            carry_labels(export_to_folders),
+                            self.uploader,
+                            ssid,
+                            file_format,
+                            file_name,
+                            sheet_id,
+                            file_folders,
+                            render,
+                            journal,
+                            (schoolid, modified_time),
+                        )
+                    )
+                self.exports.append(
+                    (
+                        futures,
+                        folders,
+                        (schoolid, ssid, format_name, modified_time),
+                        sheet_ids,
+                    )
+                )
+            save_manifest(manifest)
+
+    def finish(self):
+        """
+        Waits for every export, records the folders that are up to date and stops the
+        render processes.
+
+        Returns:
+            bool: True if every file of every school is in the journal.
+        """
+        for futures, folders, source, sheet_ids in self.exports:
+            schoolid, ssid, format_name, modified_time = source
+            for future in futures:
+                future.result()
+            # A folder is up to date once every file for it is in the journal.
+            for folder in folders:
+                if all(
+                    self.journal.done(
+                        *file_unit(
+                            schoolid, folder, format_name, sheet_id, modified_time
+                        )
+                    )
+                    for sheet_id in sheet_ids
+                ):
+                    record_push(self.manifest, ssid, folder, format_name, modified_time)
+                else:
+                    self.complete = False
+        self.exports = []
+        print(
+            f"Manifest skipped {self.skipped_exports} exports and about "
+            f"{self.skipped_calls} API calls."
+        )
+        return self.complete
+
+
+def main(resume=False, schools=SCHOOLS, formats=FILE_FORMATS, shard=None):
     """
     This function builds the necessary service objects to interact with Google Sheets and Google
     Drive APIs.
@@ -27,109 +518,59 @@ def main():
     1. Retrieves the spreadsheet ID and name for each school.
     2. Retrieves the folders associated with each school.
     3. Retrieves the sheets associated with each spreadsheet.
-    4. For each folder, it iterates over a list of file formats.
+    4. For each file format, it works out which folders don't have the current version yet.
     5. If the file format is a sheet, it checks if a file with the spreadsheet name already
-    exists in the folder.
-       If it does, it retrieves the values from the corresponding sheet and updates the sheet in the
-       destination file.
+    exists in each folder.
+       If it does, it updates the destination file from the source tabs, which are read
+       once with values.batchGet and reused for every folder.
        If it doesn't, it copies the spreadsheet to the folder.
-    6. If the file format is an XLSX file, it checks if a file with the spreadsheet name and XLSX
-    extension already exists in the folder.
-       If it does, it exports the spreadsheet to the destination file.
-       If it doesn't, it exports the spreadsheet to the folder.
-    7. If the file format is a PDF file, it iterates over the sheets associated with the
-    spreadsheet.
-       For each sheet, it checks if a file with the spreadsheet name, sheet name, and PDF extension
-       already exists in the folder.
-       If it does, it exports the sheet to the destination file.
-       If it doesn't, it exports the sheet to the folder.
-    """
-    # Build the service objects
-    for school in SCHOOLS:
-        # print(school.get("schoolid"))
-        ssid = school.get("ssid")
-        ss_name = get_ss_name(sheets_service, ssid)
-        # print(ss_name)
-        folders = school.get("folders")
-        sheets = get_sheets(sheets_service, ssid)
-        for folder in folders:
-            for file_format in FILE_FORMATS:
-                # if sheet then save name
-                if file_format.get("name") == "sheet":
-                    file_name = ss_name
-                    existing_file = find_file(drive_service, file_name, folder)
-                    if existing_file:
-                        destination_file_id = existing_file.get("id")
-                        for sheet in sheets.get("sheets"):
-                            sheet_name = sheet.get("properties").get("title")
-                            values = read_sheet(ssid, sheet_name, sheets_service)
-                            columns = {
-                                query.get("sheetName"): query.get("columns")
-                                for query in QUERIES
-                            }.get(sheet_name)
-                            update_sheet(
-                                sheets_service,
-                                destination_file_id,
-                                sheet_name,
-                                values,
-                                columns,
-                                True,
-                            )
-                    else:
-                        copy_spreadsheet(ssid, ss_name, drive_service, folder)
-
-                # if xlsx then save name with .xlsx
-                elif file_format.get("name") == ".xlsx":
-                    file_name = ss_name + file_format.get("name")
-                    existing_file = find_file(drive_service, file_name, folder)
-                    if existing_file:
-                        export_file(
-                            drive_service,
-                            ssid,
-                            file_format.get("mimeType"),
-                            file_name,
-                            folder,
-                            existing_file.get("id"),
-                        )
-                    else:
-                        export_file(
-                            drive_service,
-                            ssid,
-                            file_format.get("mimeType"),
-                            file_name,
-                            folder,
-                            None,
-                        )
+    6. If the file format is an XLSX or PDF file, each file is exported once and uploaded to
+    every folder at the same time. Exports run in the background on EXPORT_WORKERS
+    threads, within EXPORT_MEMORY_BUDGET, while the next school is handled.
+       XLSX files are named after the spreadsheet and hold every sheet. PDF files are named
+       after the spreadsheet and a sheet, and only that sheet is rendered into them.
+       Existing files are updated and missing ones are created.
+       With LOCAL_RENDER on, the files are built from the source tabs on a process pool and
+       Drive export is only used if that fails.
+    A (folder, format) is skipped when the manifest shows the spreadsheet has not been
+    modified since it was last pushed there.
+    Every (school, folder, format, tab) that is pushed is recorded in the run journal.
+    When `resume` is True the ones the last run finished are skipped.
+    Only `schools` and `formats` are worked on, so a run can be narrowed down or split
+    across workers with `shards.select_schools`.
+    The work for each school is done by `CopyRun`, which pipeline.py shares.
 
-                # if pdf then save name with sheetname and .pdf
-                elif file_format.get("name") == ".pdf":
-                    if school.get("schoolid") == 0:
-                        continue
-                    for sheet in sheets.get("sheets"):
-                        sheet_name = sheet.get("properties").get("title")
-                        file_name = (
-                            ss_name + " - " + sheet_name + file_format.get("name")
-                        )
-                        existing_file = find_file(drive_service, file_name, folder)
-                        if existing_file:
-                            export_file(
-                                drive_service,
-                                ssid,
-                                file_format.get("mimeType"),
-                                file_name,
-                                folder,
-                                existing_file.get("id"),
-                            )
-                        else:
-                            export_file(
-                                drive_service,
-                                ssid,
-                                file_format.get("mimeType"),
-                                file_name,
-                                folder,
-                                None,
-                            )
+    Parameters:
+        resume (bool): Whether to pick up where the last, unfinished run stopped.
+        schools (list): The SCHOOLS entries to copy.
+        formats (list): The FILE_FORMATS entries to copy them to.
+        shard (tuple, optional): The shard number and count, which name the run's
+        journal and metrics.
+    """
+    start_run()
+    name = run_name("copy_files", shard)
+    with Journal(name, resume) as journal:
+        manifest = load_manifest()
+        run = CopyRun(manifest, journal, formats)
+        for school in schools:
+            run.copy_school(school)
+        complete = run.finish()
+        save_manifest(manifest)
+        journal.finish(complete)
+    finish_shard("copy_files", shard, complete)
+    write_metrics(name)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Copy the backups to every folder.")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the files the last, unfinished run already pushed.",
+    )
+    add_arguments(parser, formats=True)
+    args = parser.parse_args()
+    try:
+        main(resume=args.resume, **selection(parser, args, "copy_files"))
+    except JournalBusy as error:
+        parser.exit(BUSY_EXIT, f"{error}\n")
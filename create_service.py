@@ -2,11 +2,26 @@
 Module for creating a service for interacting with Google Sheets API.
 """
 
+import json
+import multiprocessing
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from google.auth.credentials import AnonymousCredentials
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from constants import GOOGLE_API_ENDPOINT
+
+# Service objects built for each worker thread, see `thread_service`.
+_local = threading.local()
+_build_lock = threading.Lock()
+
+# Worker pools that live as long as the process, keyed by name, see `worker_pool`.
+_pools = {}
+_pools_lock = threading.Lock()
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = [
@@ -24,9 +39,18 @@ def create_service(service, version):
     credentials if expired. The function returns a service for the Google Sheets API with
     the provided credentials.
 
+    If GOOGLE_API_ENDPOINT is set, the service talks to that server without credentials
+    instead, which is how the benchmarks run against the stand-ins in fake_services.py.
+
     Returns:
         service: A service object for interacting with the Google Sheets API.
     """
+    if GOOGLE_API_ENDPOINT:
+        # Swapping the root URL in the discovery document moves the media upload and
+        # download URLs over too, which client_options.api_endpoint doesn't do.
+        document = json.loads(get_static_doc(service, version))
+        document["rootUrl"] = GOOGLE_API_ENDPOINT
+        return build_from_document(document, credentials=AnonymousCredentials())
     creds = None
     if os.path.exists("token.json"):
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
@@ -42,3 +66,71 @@ def create_service(service, version):
             token.write(creds.to_json())
 
     return build(service, version, credentials=creds)
+
+
+def thread_service(service, version):
+    """
+    Returns a service object that belongs to the calling thread.
+
+    Service objects share one HTTP connection and are not safe to use from several
+    threads, so worker threads build their own the first time they need one.
+
+    Returns:
+        service: A service object for the calling thread.
+    """
+    services = _local.__dict__.setdefault("services", {})
+    if (service, version) not in services:
+        # Building may refresh token.json, so only one thread does it at a time.
+        with _build_lock:
+            services[(service, version)] = create_service(service, version)
+    return services[(service, version)]
+
+
+def worker_pool(name, workers):
+    """
+    Returns a thread pool that is kept for the life of the process.
+
+    The services `thread_service` builds belong to the threads that built them, so a
+    pool made for every run builds them all again. The daemon runs the scripts many
+    times in one process, and these pools let it keep its workers, and their services,
+    from one cycle to the next. Callers must not shut the pool down.
+
+    Args:
+        name (str): The pool, such as "upload". Its threads are named after it.
+        workers (int): The number of threads, used when the pool is first created.
+
+    Returns:
+        ThreadPoolExecutor: The pool.
+    """
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix=name
+            )
+        return _pools[name]
+
+
+def process_pool(name, workers):
+    """
+    Returns a process pool that is kept for the life of the process, like `worker_pool`.
+
+    The scripts have threads and open connections running while the pool starts its
+    workers, and a forked worker would inherit them in whatever state they were in, so
+    the workers are started from a forkserver instead, or spawned where there is none.
+
+    Args:
+        name (str): The pool, such as "render".
+        workers (int or None): The number of processes, used when the pool is first
+        created. None uses one per CPU core.
+
+    Returns:
+        ProcessPoolExecutor: The pool.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+    else:
+        context = multiprocessing.get_context("spawn")
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        return _pools[name]
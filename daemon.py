@@ -0,0 +1,197 @@
+"""
+This module runs api_writer and copy_files on a schedule in one long-lived process.
+
+A cron run builds both Google services, loads their discovery documents, refreshes the
+OAuth token and gets a PowerSchool token before it does any work. The daemon does that
+once and keeps the services, the worker threads with the services they built, the
+pooled PowerSchool session and its token, and the metadata caches for every cycle after,
+so data such as bus routes and contacts can be refreshed through the school day without
+a cold start each time.
+
+Cycles start every DAEMON_INTERVAL minutes from DAEMON_START to DAEMON_END on
+DAEMON_DAYS. A cycle that fails is reported and the daemon waits for the next one.
+SIGTERM or Ctrl+C lets the running cycle finish and then stops.
+
+Example:
+    python daemon.py
+    python daemon.py --every 30 --start 07:00 --end 15:30 --days 0,1,2,3,4
+    python daemon.py --once
+    python daemon.py --shard 1/2 --query "Transportation Info" --query "Contact Info"
+    python daemon.py --pipeline
+"""
+
+import argparse
+import datetime
+import signal
+import threading
+import time
+import traceback
+from constants import (
+    DAEMON_DAYS,
+    DAEMON_START,
+    DAEMON_END,
+    DAEMON_INTERVAL,
+    METADATA_TTL,
+)
+from drive_functions import reset_folder_index
+from shards import add_arguments, selection
+import api_writer
+import copy_files
+import pipeline
+import sheet_functions
+
+# The scripts each cycle runs, in order, with the selector options each one takes.
+CYCLE = (
+    (api_writer, ("schools", "queries", "shard")),
+    (copy_files, ("schools", "formats", "shard")),
+)
+
+# The cycle run with --pipeline, which writes and copies each school in one pass.
+PIPELINE_CYCLE = ((pipeline, ("schools", "queries", "formats", "shard")),)
+
+
+def parse_time(text):
+    """Return the datetime.time for an HH:MM string."""
+    return datetime.datetime.strptime(text, "%H:%M").time()
+
+
+def next_cycle(now, days, start, end, interval):
+    """
+    Works out when the next cycle should start.
+
+    Args:
+        now (datetime.datetime): The current local time.
+        days (tuple): The weekdays cycles run on, Monday being 0.
+        start (datetime.time): The time of the first cycle of a day.
+        end (datetime.time): The latest time a cycle may start.
+        interval (int): Minutes between cycles, counted from `start`.
+
+    Returns:
+        datetime.datetime: The first cycle time at or after `now`, or None if `days`
+        is empty.
+    """
+    for offset in range(8):
+        day = now.date() + datetime.timedelta(days=offset)
+        if day.weekday() not in days:
+            continue
+        slot = datetime.datetime.combine(day, start)
+        last = datetime.datetime.combine(day, end)
+        while slot <= last:
+            if slot >= now:
+                return slot
+            slot += datetime.timedelta(minutes=interval)
+    return None
+
+
+def run_cycle(parser=None, args=None, cycle=CYCLE):
+    """
+    Runs every script of a cycle, carrying on past a script that fails.
+
+    Args:
+        parser (argparse.ArgumentParser, optional): The daemon's parser.
+        args (argparse.Namespace, optional): The parsed selector options. The schools
+        of a shard are worked out again for every cycle from the latest run times.
+        cycle (tuple): The scripts to run, CYCLE or PIPELINE_CYCLE.
+
+    Returns:
+        bool: True if every script finished without raising.
+    """
+    # Files may be added to or removed from the folders between cycles, so the folder
+    # listings are read again. Metadata is kept, see METADATA_TTL.
+    reset_folder_index()
+    ok = True
+    for module, options in cycle:
+        start = time.perf_counter()
+        try:
+            kwargs = {}
+            if args is not None:
+                selected = selection(parser, args, module.__name__)
+                kwargs = {option: selected[option] for option in options}
+            module.main(**kwargs)
+        except Exception:  # pylint: disable=broad-except
+            ok = False
+            print(f"An error occurred in {module.__name__}:")
+            traceback.print_exc()
+        print(f"{module.__name__} took {time.perf_counter() - start:.1f}s.")
+    return ok
+
+
+def main():
+    """Run cycles on the schedule until stopped."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--every", type=int, default=DAEMON_INTERVAL, help="Minutes between cycles."
+    )
+    parser.add_argument("--start", default=DAEMON_START, help="First cycle, HH:MM.")
+    parser.add_argument("--end", default=DAEMON_END, help="Last cycle start, HH:MM.")
+    parser.add_argument(
+        "--days",
+        default=",".join(str(day) for day in DAEMON_DAYS),
+        help="Weekdays to run on, Monday being 0, such as 0,1,2,3,4.",
+    )
+    parser.add_argument(
+        "--now", action="store_true", help="Run a cycle now, then keep the schedule."
+    )
+    parser.add_argument("--once", action="store_true", help="Run one cycle and exit.")
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Run pipeline.py instead of api_writer.py and then copy_files.py.",
+    )
+    add_arguments(parser, queries=True, formats=True)
+    args = parser.parse_args()
+    # Check the selectors before the first cycle rather than when it runs.
+    selection(parser, args, "api_writer")
+    days = tuple(int(day) for day in args.days.split(",") if day.strip())
+    start, end = parse_time(args.start), parse_time(args.end)
+    cycle = PIPELINE_CYCLE if args.pipeline else CYCLE
+    # Keep the metadata cache warm from one cycle to the next when they are further
+    # apart than the default.
+    sheet_functions.METADATA_TTL = max(METADATA_TTL, 2 * args.every * 60)
+
+    if args.once:
+        run_cycle(parser, args, cycle)
+        return
+
+    stopping = threading.Event()
+
+    def stop(signum, _frame):
+        print(f"Got signal {signum}, stopping after the current cycle.")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    run_now = args.now
+    last = None
+    while not stopping.is_set():
+        if not run_now:
+            after = datetime.datetime.now()
+            if last is not None:
+                # Never the slot that just ran, even if the cycle was quick.
+                after = max(after, last + datetime.timedelta(seconds=1))
+            when = next_cycle(after, days, start, end, args.every)
+            if when is None:
+                print("No days to run on, stopping.")
+                return
+            print(f"Next cycle at {when:%m-%d-%Y %I:%M %p}.")
+            # Sleep in short steps so a clock change or a signal is noticed.
+            while not stopping.is_set() and datetime.datetime.now() < when:
+                remaining = (when - datetime.datetime.now()).total_seconds()
+                stopping.wait(min(max(remaining, 0), 60))
+            if stopping.is_set():
+                break
+            last = when
+        run_now = False
+        cycle_start = datetime.datetime.now()
+        print(f"Cycle started at {cycle_start:%m-%d-%Y %I:%M %p}.")
+        ok = run_cycle(parser, args, cycle)
+        print(
+            f"Cycle {'finished' if ok else 'finished with errors'} in "
+            f"{(datetime.datetime.now() - cycle_start).total_seconds():.1f}s."
+        )
+    print("Daemon stopped.")
+
+
+if __name__ == "__main__":
+    main()
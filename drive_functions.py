@@ -3,49 +3,244 @@ This module contains functions for interacting with the Google Drive API.
 """
 
 import io
-from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
+import os
+import tempfile
+import threading
+from urllib.parse import urlencode
+from googleapiclient.http import HttpRequest, MediaIoBaseDownload, MediaIoBaseUpload
 from googleapiclient.errors import HttpError
+from constants import (
+    DOWNLOAD_CHUNK_SIZE,
+    UPLOAD_CHUNK_SIZE,
+    SPOOL_LIMIT,
+    EXPORT_MEMORY_BUDGET,
+    PDF_WORKERS,
+    GOOGLE_API_ENDPOINT,
+)
+from request_executor import execute, DRIVE
 
+# The Sheets export endpoint, which unlike files.export can render a single tab.
+SHEET_EXPORT_URL = (GOOGLE_API_ENDPOINT or "https://docs.google.com/") + (
+    "spreadsheets/d/{}/export"
+)
 
-def find_file(service, file_name, parent_id, count=0):
+# The export endpoint's format name for each MIME type it can render a single tab as.
+SHEET_EXPORT_FORMATS = {
+    "application/pdf": "pdf",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx",
+}
+
+# Caps how many single-tab renders run at once.
+_render_limit = threading.BoundedSemaphore(PDF_WORKERS)
+
+# Name to file maps for each folder listed during this run, keyed by folder ID.
+_folder_index = {}
+_folder_lock = threading.Lock()
+
+# Bytes of memory held by the exports in flight, see `reserve_memory`.
+_memory_used = 0
+_memory_lock = threading.Lock()
+
+
+class SpillBuffer:
+    """
+    A download target that keeps an export in memory until it grows past `limit` or
+    past what is left of EXPORT_MEMORY_BUDGET, and then moves it to a temporary file.
+
+    Once the download has finished, `open` can be called any number of times, from any
+    thread, to get an independent reader over the content.
+    """
+
+    def __init__(self, limit=SPOOL_LIMIT):
+        self.limit = limit
+        self.size = 0
+        self.reserved = 0
+        self.path = None
+        self.content = None
+        self._buffer = io.BytesIO()
+        self._file = None
+
+    def write(self, data):
+        """Append downloaded bytes, moving to disk once they don't fit in memory."""
+        if self._file is None:
+            if self.size + len(data) <= self.limit and reserve_memory(len(data)):
+                self.reserved += len(data)
+            else:
+                handle, self.path = tempfile.mkstemp(prefix="export-")
+                self._file = os.fdopen(handle, "wb")
+                self._file.write(self._buffer.getvalue())
+                self._buffer = None
+                release_memory(self.reserved)
+                self.reserved = 0
+        (self._file or self._buffer).write(data)
+        self.size += len(data)
+        return len(data)
+
+    def finish(self):
+        """Mark the download as done so the content can be read."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        elif self._buffer is not None:
+            self.content = self._buffer.getvalue()
+            self._buffer = None
+
+    def open(self):
+        """Return a new binary reader over the downloaded content."""
+        if self.path:
+            return open(self.path, "rb")
+        return io.BytesIO(self.content)
+
+    def discard(self):
+        """Free the memory or temporary file holding the content."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.content = None
+        self._buffer = None
+        release_memory(self.reserved)
+        self.reserved = 0
+
+
+def reserve_memory(size):
+    """
+    Reserves `size` bytes of EXPORT_MEMORY_BUDGET for an export held in memory.
+
+    Returns:
+        bool: True if the bytes were reserved, False if they don't fit in what is left
+        of the budget, in which case the export should go to disk instead.
+    """
+    global _memory_used
+    with _memory_lock:
+        if _memory_used + size > EXPORT_MEMORY_BUDGET:
+            return False
+        _memory_used += size
+        return True
+
+
+def release_memory(size):
+    """Give back memory reserved with `reserve_memory`."""
+    global _memory_used
+    with _memory_lock:
+        _memory_used -= size
+
+
+def list_folder(service, parent_id):
+    """
+    Lists every file in a Google Drive folder, following the result pages.
+
+    Args:
+        service (googleapiclient.discovery.Resource): An authenticated Google Drive API
+        service object.
+        parent_id (str): The ID of the folder to list.
+
+    Returns:
+        dict or None: The files in the folder keyed by name, or None if it could not be
+        listed. If several files share a name the first one listed is kept.
+    """
+    try:
+        files = {}
+        page_token = None
+        while True:
+            results = execute(
+                service.files().list(
+                    q=f"'{parent_id}' in parents and trashed = false",
+                    spaces="drive",
+                    fields="nextPageToken, files(id, name)",
+                    pageSize=1000,
+                    pageToken=page_token,
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True,
+                ),
+                DRIVE,
+                "list_folder",
+            )
+            for file in results.get("files", []):
+                files.setdefault(file.get("name"), file)
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                return files
+    except HttpError as error:
+        print(f"An error occurred in list_folder: {error}")
+        return None
+
+
+def get_folder_index(service, parent_id):
+    """
+    Returns the name to file map for a folder, listing the folder the first time only.
+
+    Args:
+        service (googleapiclient.discovery.Resource): An authenticated Google Drive API
+        service object.
+        parent_id (str): The ID of the folder.
+
+    Returns:
+        dict or None: The files in the folder keyed by name, or None if it could not be
+        listed.
+    """
+    with _folder_lock:
+        if parent_id in _folder_index:
+            return _folder_index[parent_id]
+    files = list_folder(service, parent_id)
+    if files is None:
+        return None
+    with _folder_lock:
+        return _folder_index.setdefault(parent_id, files)
+
+
+def add_to_folder_index(parent_id, file_name, file_id):
+    """Record a file created in a folder so later lookups find it without listing."""
+    with _folder_lock:
+        if parent_id in _folder_index:
+            _folder_index[parent_id][file_name] = {"id": file_id, "name": file_name}
+
+
+def reset_folder_index():
+    """Forget every folder listing so the next lookup lists the folders again."""
+    with _folder_lock:
+        _folder_index.clear()
+
+
+def find_file(service, file_name, parent_id):
     """
     Find a file in Google Drive with the given file name and parent ID.
 
+    The lookup is answered from the folder index, so each folder is only listed once per
+    run. If the folder can't be listed, the file is searched for directly.
+
     Args:
         service (googleapiclient.discovery.Resource): An authenticated Google Drive API
         service object.
         file_name (str): The name of the file to search for.
         parent_id (str): The ID of the parent folder to search in.
-        count (int, optional): The number of times the function has been retried (default: 0).
 
     Returns:
         dict or None: A dictionary representing the file if found, or None if not found.
 
-    Raises:
-        HttpError: If an error occurs during the API request.
-
     Notes:
-        - The function retries up to 3 times if an error occurs.
+        - Failed requests are retried by `request_executor.execute`.
         - The function searches for files with the given name in the specified parent folder.
         - The function returns the first match it finds.
         - The function returns None if no matching file is found.
     """
+    files = get_folder_index(service, parent_id)
+    if files is not None:
+        return files.get(file_name)
     try:
-        if count >= 3:
-            print("Hit max retries for find_file, returning None")
-            return None
         # print(f"Searching for {file_name} in {parent_id}")
         query = f"name = '{file_name}' and '{parent_id}' in parents and trashed = false"
-        results = (
-            service.files()
-            .list(
+        results = execute(
+            service.files().list(
                 q=query,
                 spaces="drive",
                 fields="files(id, name)",
                 supportsAllDrives=True,
                 includeItemsFromAllDrives=True,
-            )
-            .execute()
+            ),
+            DRIVE,
+            "find_file",
         )
         # print(results)
         files = results.get("files", [])
@@ -53,94 +248,168 @@ def find_file(service, file_name, parent_id, count=0):
             return files[0]  # Return the first match
         return None
     except HttpError as error:
-        print(f"An error occurred in find_file - Retying: {error}")
-        find_file(service, file_name, parent_id, count + 1)
+        print(f"An error occurred in find_file: {error}")
+        return None
 
 
-def export_file(
-    service, file_id, mime_type, export_path, folder_id, update_existing, count=0
-):
+def get_modified_time(service, file_id):
+    """
+    Gets the time a file in Google Drive was last modified.
+
+    Args:
+        service (googleapiclient.discovery.Resource): An authenticated Google Drive API
+        service object.
+        file_id (str): The ID of the file.
+
+    Returns:
+        str or None: The file's modifiedTime, or None if it could not be read.
     """
-    Export a file from Google Drive.
+    try:
+        result = execute(
+            service.files().get(
+                fileId=file_id, fields="modifiedTime", supportsAllDrives=True
+            ),
+            DRIVE,
+            "get_modified_time",
+        )
+        return result.get("modifiedTime")
+    except HttpError as error:
+        print(f"An error occurred in get_modified_time: {error}")
+        return None
+
+
+def sheet_export_request(service, file_id, mime_type, sheet_id):
+    """
+    Builds a request that renders one tab of a spreadsheet through the export endpoint.
+
+    Args:
+        service (googleapiclient.discovery.Resource): An authenticated Google Drive
+        API service object, whose authorized HTTP client is used for the request.
+        file_id (str): The ID of the spreadsheet.
+        mime_type (str): The MIME type to export to.
+        sheet_id (int): The sheetId of the tab to render.
+
+    Returns:
+        HttpRequest: A request that can be passed to MediaIoBaseDownload.
+    """
+    params = {
+        "format": SHEET_EXPORT_FORMATS[mime_type],
+        "gid": sheet_id,
+        "portrait": "false",
+        "fitw": "true",
+        "gridlines": "true",
+        "sheetnames": "false",
+        "printtitle": "false",
+        "fzr": "true",
+    }
+    uri = SHEET_EXPORT_URL.format(file_id) + "?" + urlencode(params)
+    # pylint: disable=protected-access
+    return HttpRequest(service._http, lambda response, content: content, uri)
+
+
+def download_export(service, file_id, mime_type, sheet_id=None):
+    """
+    Exports a Google Drive file in the given format and downloads the result.
+
+    The export is fetched DOWNLOAD_CHUNK_SIZE bytes at a time into a `SpillBuffer`, so it
+    only stays in memory while it is smaller than SPOOL_LIMIT and fits in what is left
+    of EXPORT_MEMORY_BUDGET.
+    If `sheet_id` is given, only that tab of the spreadsheet is rendered, with at most
+    PDF_WORKERS tabs rendering at once.
 
     Args:
         service (googleapiclient.discovery.Resource): An authenticated Google Drive
         API service object.
         file_id (str): The ID of the file to export.
-        mime_type (str): The MIME type of the file.
-        export_path (str): The path to export the file to.
-        folder_id (str): The ID of the folder to export the file to.
-        update_existing (bool): Whether to update an existing file or create a new one.
-        count (int, optional): The number of times the function has been retried (default: 0).
+        mime_type (str): The MIME type to export to.
+        sheet_id (int, optional): The sheetId of a single tab to export.
 
     Returns:
-        str or None: The ID of the exported file if successful, None if an error occurs.
+        SpillBuffer or None: The exported content, or None if an error occurs. Call its
+        `discard` method once it has been uploaded.
+    """
 
-    Raises:
-        HttpError: If an error occurs during the API request.
+    def download():
+        # Each attempt starts over in a fresh buffer.
+        if sheet_id is None:
+            request = service.files().export_media(fileId=file_id, mimeType=mime_type)
+        else:
+            request = sheet_export_request(service, file_id, mime_type, sheet_id)
+        buffer = SpillBuffer()
+        try:
+            downloader = MediaIoBaseDownload(
+                buffer, request, chunksize=DOWNLOAD_CHUNK_SIZE
+            )
+            done = False
+            while done is False:
+                _, done = downloader.next_chunk()
+            buffer.finish()
+            return buffer
+        except BaseException:
+            buffer.discard()
+            raise
 
-    Notes:
-        - The function retries up to 3 times if an error occurs.
-        - If `update_existing` is False, a new file is created to receive the exported content.
-        - If `update_existing` is True, the existing file with the specified `file_id` is updated.
-        - The exported content is downloaded into an in-memory file-like object before being uploaded
-        to the new file.
-        - The function prints a message indicating the file that was updated.
-    """
     try:
-        if count >= 3:
-            print("Hit max retries for export_file, returning None")
-            return None
-        # 1. Initiate the export request
-        request = service.files().export_media(fileId=file_id, mimeType=mime_type)
-
-        # 2. Create file metadata for the exported file
-        file_metadata = {
-            "mimeType": mime_type,
-            "name": export_path,
-            "parents": [folder_id],
-        }
+        if sheet_id is None:
+            return execute(download, DRIVE, "download_export")
+        with _render_limit:
+            return execute(download, DRIVE, "download_export")
+    except HttpError as error:
+        print(f"An error occurred in download_export: {error}")
+        return None
 
-        if not update_existing:
 
-            # 3. Create an empty file to receive the exported content
-            new_file = (
-                service.files()
-                .create(body=file_metadata, fields="id", supportsAllDrives=True)
-                .execute()
+def upload_export(
+    service, content, mime_type, export_path, folder_id, update_existing
+):
+    """
+    Uploads exported content to a Google Drive file, creating the file if needed.
+
+    Args:
+        service (googleapiclient.discovery.Resource): An authenticated Google Drive
+        API service object.
+        content (SpillBuffer): The exported content from `download_export`.
+        mime_type (str): The MIME type of the content.
+        export_path (str): The name of the file.
+        folder_id (str): The ID of the folder the file is in.
+        update_existing (str or None): The ID of the file to update, or None to create one.
+
+    Returns:
+        str or None: The ID of the uploaded file if successful, None if an error occurs.
+    """
+
+    def upload():
+        # Each attempt reads from its own handle, so uploads can run side by side and a
+        # retry starts from the beginning of the content.
+        with content.open() as fh:
+            media_body = MediaIoBaseUpload(
+                fh, mimetype=mime_type, chunksize=UPLOAD_CHUNK_SIZE, resumable=True
             )
-            new_file_id = new_file.get("id")
-            # print(f"File ID: {new_file_id}")
+            service.files().update(
+                fileId=update_existing, media_body=media_body, supportsAllDrives=True
+            ).execute()
 
-        else:
-            new_file_id = update_existing
-
-        # 4. Download the exported content into the new file
-        fh = io.BytesIO()  # Create an in-memory file-like object to store the download
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while done is False:
-            done = downloader.next_chunk()
-
-        # 5. Upload downloaded content to the new file
-        fh.seek(0)  # Reset the file pointer to the beginning
-        media_body = MediaIoBaseUpload(
-            fh, mimetype=mime_type, resumable=True
-        )  # Create MediaIoBaseUpload object
-        service.files().update(
-            fileId=new_file_id, media_body=media_body, supportsAllDrives=True
-        ).execute()
-        print(f"File updated: {export_path}")
-        return new_file_id
+    try:
+        if not update_existing:
+            # Create an empty file to receive the exported content
+            file_metadata = {
+                "mimeType": mime_type,
+                "name": export_path,
+                "parents": [folder_id],
+            }
+            new_file = execute(
+                service.files().create(
+                    body=file_metadata, fields="id", supportsAllDrives=True
+                ),
+                DRIVE,
+                "upload_export",
+            )
+            update_existing = new_file.get("id")
+            add_to_folder_index(folder_id, export_path, update_existing)
 
+        execute(upload, DRIVE, "upload_export", sent=content.size)
+        print(f"File updated: {export_path}")
+        return update_existing
     except HttpError as error:
-        print(f"An error occurred in export_file - Retrying: {error}")
-        export_file(
-            service,
-            file_id,
-            mime_type,
-            export_path,
-            folder_id,
-            update_existing,
-            count + 1,
-        )
+        print(f"An error occurred in upload_export: {error}")
+        return None
@@ -0,0 +1,623 @@
+"""
+This module contains local stand-ins for the PowerSchool, Google Sheets and Google Drive
+APIs, so the scripts can be benchmarked without touching the real services.
+
+Each stand-in is an HTTP server on localhost that answers the requests the scripts make
+from an in-memory dataset. Latency, server errors and 429s can be injected at set rates,
+and every request is counted per endpoint along with the bytes it moved. Point the
+scripts at them with the PS_BASE_URL and GOOGLE_API_ENDPOINT environment variables, as
+benchmark.py does.
+"""
+
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from constants import QUERIES, SCHOOLS, SCHOOL_COLUMN, DISTRICT_SCHOOLID
+from render_functions import render_xlsx, render_pdf
+
+# Rows each student has in a query, for the queries with more than one.
+ROWS_PER_STUDENT = {"Schedule Info": 7, "Contact Info": 3}
+
+# Buses the generated students are spread over.
+BUS_COUNT = 40
+
+SPREADSHEET_MIME_TYPE = "application/vnd.google-apps.spreadsheet"
+
+# What is counted for each endpoint.
+STAT_FIELDS = ("calls", "bytes_in", "bytes_out", "errors", "throttled")
+
+
+class FakeService:
+    """
+    An HTTP server that answers requests through `route` and injects faults and latency.
+
+    Subclasses implement `route`, which returns (endpoint name, status, headers, body).
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.stats = {}
+        self.server = None
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        """Return the base URL of the running server, ending in a slash."""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        """Start serving on a free localhost port in a background thread."""
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Hands every request to the service."""
+
+            protocol_version = "HTTP/1.1"
+
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                status, headers, payload = service.respond(
+                    self.command, self.path, body, self.headers
+                )
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def take_stats(self):
+        """Return the per-endpoint counts since the last call and start new ones."""
+        with self._lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def count(self, endpoint, received, sent, outcome=None):
+        """Add a request to the per-endpoint counts."""
+        with self._lock:
+            entry = self.stats.setdefault(
+                endpoint, dict.fromkeys(STAT_FIELDS, 0)
+            )
+            entry["calls"] += 1
+            entry["bytes_in"] += received
+            entry["bytes_out"] += sent
+            if outcome:
+                entry[outcome] += 1
+
+    def fault(self):
+        """Return "throttled", "errors" or None, at the configured rates."""
+        with self._lock:
+            roll = self.random.random()
+        if roll < self.throttle_rate:
+            return "throttled"
+        if roll < self.throttle_rate + self.error_rate:
+            return "errors"
+        return None
+
+    def respond(self, method, path, body, headers):
+        """Answer one request, after the injected latency and faults."""
+        if self.latency:
+            with self._lock:
+                factor = self.random.uniform(0.5, 1.5)
+            time.sleep(self.latency * factor)
+        parsed = urlparse(path)
+        params = parse_qs(parsed.query)
+        try:
+            endpoint, status, reply_headers, payload = self.route(
+                method, parsed.path, params, body, headers
+            )
+        except (KeyError, ValueError) as error:
+            endpoint, status, reply_headers, payload = (
+                f"{method} {parsed.path}",
+                404,
+                {},
+                json_body({"error": {"code": 404, "message": str(error)}}),
+            )
+        outcome = self.fault() if status < 400 else None
+        if outcome:
+            status, reason, message = (
+                (429, "rateLimitExceeded", "Rate Limit Exceeded")
+                if outcome == "throttled"
+                else (503, "backendError", "Backend Error")
+            )
+            reply_headers = {"Content-Type": "application/json"}
+            error = {"code": status, "message": message, "errors": [{"reason": reason}]}
+            payload = json_body({"error": error})
+        self.count(endpoint, len(body), len(payload), outcome)
+        return status, reply_headers, payload
+
+    def route(self, method, path, params, body, headers):
+        """Return (endpoint name, status, headers, body) for a request."""
+        raise NotImplementedError
+
+
+def json_body(data):
+    """Return data encoded as a JSON response body."""
+    return json.dumps(data).encode("utf-8")
+
+
+def json_reply(endpoint, data, status=200):
+    """Return a JSON reply in the form `route` returns."""
+    return endpoint, status, {"Content-Type": "application/json"}, json_body(data)
+
+
+def student_record(query, student, copy, schoolid):
+    """
+    Builds one generated PowerSchool record.
+
+    Parameters:
+        query (dict): The query entry from QUERIES.
+        student (int): The number of the student.
+        copy (int): Which of the student's rows in the query this is.
+        schoolid (int): The building of the student.
+
+    Returns:
+        dict: The record, shaped like the ones PowerSchool returns.
+    """
+    students = {SCHOOL_COLUMN: str(schoolid)}
+    for index, column in enumerate(query.get("columns")):
+        if column == "student_number":
+            value = str(100000 + student)
+        elif column == "lastfirst":
+            value = f"Student{student:05d}, Test"
+        elif column == "period_number":
+            value = str(copy + 1)
+        elif column == "contname":
+            value = f"Contact {copy + 1}"
+        elif column.endswith("_bus"):
+            value = str(student % BUS_COUNT + 1)
+        elif (student + index) % 7 == 0:
+            # PowerSchool leaves empty fields out of the record.
+            continue
+        else:
+            value = f"{column} {student}-{copy}"
+        students[column] = value
+    return {"tables": {"students": students}}
+
+
+class FakePowerSchool(FakeService):
+    """
+    Stands in for PowerSchool: the OAuth token endpoint and the PowerQueries in QUERIES,
+    with their /count endpoints and pagesize/page paging.
+    """
+
+    def __init__(self, students=2000, **kwargs):
+        super().__init__(**kwargs)
+        buildings = [
+            school.get("schoolid")
+            for school in SCHOOLS
+            if school.get("schoolid") != DISTRICT_SCHOOLID
+        ]
+        self.queries = {}
+        for query in QUERIES:
+            copies = ROWS_PER_STUDENT.get(query.get("sheetName"), 1)
+            self.queries[urlparse(query.get("url")).path] = [
+                student_record(
+                    query, student, copy, buildings[student % len(buildings)]
+                )
+                for student in range(students)
+                for copy in range(copies)
+            ]
+        self._pages = {}
+
+    def advance(self, churn):
+        """
+        Changes a share of the records, as happens between two real runs.
+
+        Parameters:
+            churn (float): The share of records to change.
+        """
+        with self._lock:
+            for records in self.queries.values():
+                for record in self.random.sample(records, int(len(records) * churn)):
+                    students = record["tables"]["students"]
+                    column = [name for name in students if name != SCHOOL_COLUMN][-1]
+                    students[column] = f"{students[column]} changed"
+            self._pages.clear()
+
+    def school_records(self, path, schoolid):
+        """Return the records of a query for a building, or all of them for 0."""
+        records = self.queries[path]
+        if schoolid == DISTRICT_SCHOOLID:
+            return records
+        return [
+            record
+            for record in records
+            if record["tables"]["students"][SCHOOL_COLUMN] == str(schoolid)
+        ]
+
+    def route(self, method, path, params, body, headers):
+        if path == "/oauth/access_token":
+            return json_reply(
+                "oauth.token",
+                {
+                    "access_token": "fake-token",
+                    "token_type": "Bearer",
+                    "expires_in": "3600",
+                },
+            )
+        payload = json.loads(body or b"{}")
+        schoolid = int(payload.get("schoolid", DISTRICT_SCHOOLID))
+        if path.endswith("/count"):
+            records = self.school_records(path[: -len("/count")], schoolid)
+            return json_reply("query.count", {"count": len(records)})
+        page_size = int(params.get("pagesize", ["0"])[0])
+        page = int(params.get("page", ["1"])[0])
+        key = (path, schoolid, page_size, page)
+        with self._lock:
+            cached = self._pages.get(key)
+        if cached is None:
+            records = self.school_records(path, schoolid)
+            if page_size:
+                records = records[(page - 1) * page_size : page * page_size]
+            cached = json_body({"name": path.rsplit("/", 1)[-1], "record": records})
+            with self._lock:
+                self._pages[key] = cached
+        return "query.page", 200, {"Content-Type": "application/json"}, cached
+
+
+def parse_range(range_name):
+    """
+    Splits an A1 range into the sheet title and its top left cell.
+
+    Parameters:
+        range_name (str): A range such as 'Contact Info'!A2:K9, or just a sheet name.
+
+    Returns:
+        tuple: The title and the 0-based row and column of the first cell.
+    """
+    title, _, cells = range_name.rpartition("!")
+    if not title:
+        title, cells = cells, ""
+    if title.startswith("'") and title.endswith("'"):
+        title = title[1:-1].replace("''", "'")
+    match = re.match(r"([A-Z]*)(\d*)", cells)
+    column = 0
+    for letter in match.group(1):
+        column = column * 26 + ord(letter) - 64
+    row = int(match.group(2)) if match.group(2) else 1
+    return title, row - 1, max(column - 1, 0)
+
+
+def trimmed(values):
+    """Return values the way Sheets reads them back, without trailing empty cells."""
+    rows = []
+    for row in values:
+        end = len(row)
+        while end and row[end - 1] == "":
+            end -= 1
+        rows.append(row[:end])
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+class FakeGoogle(FakeService):
+    """
+    Stands in for the Sheets v4 and Drive v3 endpoints the scripts use, including
+    resumable uploads, ranged export downloads and single-tab exports.
+
+    Every spreadsheet in SCHOOLS exists from the start, with no tabs.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.files = {}
+        self.tabs = {}
+        self.uploads = {}
+        self._ids = itertools.count(1)
+        for school in SCHOOLS:
+            self.add_file(
+                school.get("ssid"),
+                f"School {school.get('schoolid')} Backup",
+                SPREADSHEET_MIME_TYPE,
+                [],
+            )
+            self.tabs[school.get("ssid")] = []
+
+    def new_id(self):
+        """Return an unused file or sheet ID."""
+        return f"fake{next(self._ids)}"
+
+    def add_file(self, file_id, name, mime_type, parents, content=b""):
+        """Add a file to the fake Drive and return it."""
+        self.files[file_id] = {
+            "id": file_id,
+            "name": name,
+            "mimeType": mime_type,
+            "parents": parents,
+            "content": content,
+            "modifiedTime": "",
+        }
+        self.touch(file_id)
+        return self.files[file_id]
+
+    def touch(self, file_id):
+        """Set a file's modifiedTime to now."""
+        self.files[file_id]["modifiedTime"] = time.strftime(
+            "%Y-%m-%dT%H:%M:%S.", time.gmtime()
+        ) + f"{int(time.time() * 1000) % 1000:03d}Z"
+
+    def find_tab(self, spreadsheet_id, title=None, sheet_id=None):
+        """Return a tab of a spreadsheet by title or sheetId."""
+        for tab in self.tabs[spreadsheet_id]:
+            if tab["title"] == title or tab["sheetId"] == sheet_id:
+                return tab
+        raise KeyError(f"No tab {title or sheet_id} in {spreadsheet_id}")
+
+    def metadata(self, spreadsheet_id):
+        """Return the spreadsheets.get response for a spreadsheet."""
+        return {
+            "spreadsheetId": spreadsheet_id,
+            "properties": {"title": self.files[spreadsheet_id]["name"]},
+            "sheets": [
+                {
+                    "properties": {
+                        "sheetId": tab["sheetId"],
+                        "title": tab["title"],
+                        "index": index,
+                    }
+                }
+                for index, tab in enumerate(self.tabs[spreadsheet_id])
+            ],
+        }
+
+    def write_values(self, spreadsheet_id, range_name, values):
+        """Write a block of values into a tab, growing it as needed."""
+        title, row, column = parse_range(range_name)
+        grid = self.find_tab(spreadsheet_id, title)["values"]
+        for offset, cells in enumerate(values):
+            while len(grid) <= row + offset:
+                grid.append([])
+            target = grid[row + offset]
+            while len(target) < column + len(cells):
+                target.append("")
+            for index, value in enumerate(cells):
+                target[column + index] = "" if value is None else str(value)
+        self.touch(spreadsheet_id)
+        return {"updatedRange": range_name, "updatedRows": len(values)}
+
+    def read_values(self, spreadsheet_id, range_name):
+        """Return the values.get response for a whole tab."""
+        title = parse_range(range_name)[0]
+        return {
+            "range": range_name,
+            "majorDimension": "ROWS",
+            "values": trimmed(self.find_tab(spreadsheet_id, title)["values"]),
+        }
+
+    def render(self, spreadsheet_id, mime_type, sheet_id=None):
+        """Return a spreadsheet, or one tab of it, rendered as XLSX or PDF."""
+        tabs = self.tabs[spreadsheet_id]
+        if sheet_id is not None:
+            tabs = [self.find_tab(spreadsheet_id, sheet_id=sheet_id)]
+        if mime_type == "application/pdf" or mime_type == "pdf":
+            return render_pdf(
+                self.files[spreadsheet_id]["name"],
+                [row for tab in tabs for row in trimmed(tab["values"])],
+            )
+        return render_xlsx([(tab["title"], trimmed(tab["values"])) for tab in tabs])
+
+    def download(self, endpoint, content, headers):
+        """Return a reply for a download, honoring a Range header."""
+        match = re.match(r"bytes=(\d+)-(\d*)", headers.get("Range") or "")
+        if not match:
+            return endpoint, 200, {}, content
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(content) - 1), len(content) - 1)
+        return (
+            endpoint,
+            206,
+            {"Content-Range": f"bytes {start}-{end}/{len(content)}"},
+            content[start : end + 1],
+        )
+
+    def route(self, method, path, params, body, headers):
+        # pylint: disable=too-many-return-statements,too-many-branches
+        data = {}
+        if body and "json" in (headers.get("Content-Type") or ""):
+            data = json.loads(body)
+        with self._lock:
+            match = re.fullmatch(r"/v4/spreadsheets/([^/:]+)", path)
+            if match and method == "GET":
+                return json_reply("sheets.get", self.metadata(match.group(1)))
+            match = re.fullmatch(r"/v4/spreadsheets/([^/:]+):batchUpdate", path)
+            if match:
+                return json_reply(
+                    "sheets.batchUpdate",
+                    self.batch_update(match.group(1), data.get("requests", [])),
+                )
+            match = re.fullmatch(r"/v4/spreadsheets/([^/]+)/values:batchGet", path)
+            if match:
+                return json_reply(
+                    "values.batchGet",
+                    {
+                        "spreadsheetId": match.group(1),
+                        "valueRanges": [
+                            self.read_values(match.group(1), range_name)
+                            for range_name in params.get("ranges", [])
+                        ],
+                    },
+                )
+            match = re.fullmatch(r"/v4/spreadsheets/([^/]+)/values:batchUpdate", path)
+            if match:
+                responses = [
+                    self.write_values(match.group(1), entry["range"], entry["values"])
+                    for entry in data.get("data", [])
+                ]
+                return json_reply(
+                    "values.batchUpdate",
+                    {
+                        "totalUpdatedRows": sum(
+                            response["updatedRows"] for response in responses
+                        ),
+                        "responses": responses,
+                    },
+                )
+            match = re.fullmatch(r"/v4/spreadsheets/([^/]+)/values/([^/]+):clear", path)
+            if match:
+                title = parse_range(unquote(match.group(2)))[0]
+                self.find_tab(match.group(1), title)["values"] = []
+                self.touch(match.group(1))
+                return json_reply("values.clear", {"clearedRange": title})
+            match = re.fullmatch(r"/v4/spreadsheets/([^/]+)/values/([^/]+)", path)
+            if match and method == "GET":
+                values = self.read_values(match.group(1), unquote(match.group(2)))
+                return json_reply("values.get", values)
+            if match:
+                return json_reply(
+                    "values.update",
+                    self.write_values(
+                        match.group(1),
+                        unquote(match.group(2)),
+                        data.get("values", []),
+                    ),
+                )
+            match = re.fullmatch(r"/spreadsheets/d/([^/]+)/export", path)
+            if match:
+                content = self.render(
+                    match.group(1), params["format"][0], int(params["gid"][0])
+                )
+                return self.download("sheets.export", content, headers)
+            if path == "/drive/v3/files" and method == "GET":
+                return json_reply("files.list", self.list_files(params))
+            if path == "/drive/v3/files":
+                new_file = self.add_file(
+                    self.new_id(),
+                    data.get("name"),
+                    data.get("mimeType"),
+                    data.get("parents", []),
+                )
+                return json_reply("files.create", {"id": new_file["id"]})
+            match = re.fullmatch(r"/drive/v3/files/([^/]+)/copy", path)
+            if match:
+                return json_reply("files.copy", self.copy_file(match.group(1), data))
+            match = re.fullmatch(r"/drive/v3/files/([^/]+)/export", path)
+            if match:
+                content = self.render(match.group(1), params["mimeType"][0])
+                return self.download("files.export", content, headers)
+            match = re.fullmatch(r"/drive/v3/files/([^/]+)", path)
+            if match:
+                file = self.files[match.group(1)]
+                return json_reply(
+                    "files.get",
+                    {key: value for key, value in file.items() if key != "content"},
+                )
+            match = re.fullmatch(r"/upload/drive/v3/files/([^/]+)", path)
+            if match:
+                return self.upload(match.group(1), params, body, headers)
+        raise KeyError(f"No route for {method} {path}")
+
+    def batch_update(self, spreadsheet_id, requests):
+        """Apply the structural requests of a spreadsheets.batchUpdate."""
+        replies = []
+        for request in requests:
+            if "addSheet" in request:
+                properties = dict(request["addSheet"].get("properties", {}))
+                properties["sheetId"] = int(next(self._ids))
+                self.tabs[spreadsheet_id].append(
+                    {
+                        "sheetId": properties["sheetId"],
+                        "title": properties["title"],
+                        "values": [],
+                    }
+                )
+                replies.append({"addSheet": {"properties": properties}})
+                continue
+            if "updateCells" in request:
+                sheet_id = request["updateCells"]["range"]["sheetId"]
+                self.find_tab(spreadsheet_id, sheet_id=sheet_id)["values"] = []
+            replies.append({})
+        self.touch(spreadsheet_id)
+        return {"spreadsheetId": spreadsheet_id, "replies": replies}
+
+    def list_files(self, params):
+        """Return a files.list page for a parent folder query."""
+        query = params.get("q", [""])[0]
+        parent = re.search(r"'([^']+)' in parents", query)
+        name = re.search(r"name = '((?:[^'\\]|\\.)*)'", query)
+        files = [
+            {"id": file["id"], "name": file["name"]}
+            for file in self.files.values()
+            if (parent is None or parent.group(1) in file["parents"])
+            and (name is None or file["name"] == name.group(1))
+        ]
+        page_size = int(params.get("pageSize", ["100"])[0])
+        start = int(params.get("pageToken", ["0"])[0])
+        result = {"files": files[start : start + page_size]}
+        if start + page_size < len(files):
+            result["nextPageToken"] = str(start + page_size)
+        return result
+
+    def copy_file(self, file_id, data):
+        """Copy a spreadsheet, tabs and all, and return the new file."""
+        source = self.files[file_id]
+        new_file = self.add_file(
+            self.new_id(),
+            data.get("name", source["name"]),
+            source["mimeType"],
+            data.get("parents", []),
+        )
+        self.tabs[new_file["id"]] = [
+            {**tab, "values": [list(row) for row in tab["values"]]}
+            for tab in self.tabs.get(file_id, [])
+        ]
+        return {key: value for key, value in new_file.items() if key != "content"}
+
+    def upload(self, file_id, params, body, headers):
+        """Handle the steps of a resumable upload, or a simple media upload."""
+        upload_id = params.get("upload_id", [None])[0]
+        if params.get("uploadType", [""])[0] == "resumable" and upload_id is None:
+            upload_id = self.new_id()
+            self.uploads[upload_id] = bytearray()
+            location = (
+                f"{self.url}upload/drive/v3/files/{file_id}"
+                f"?uploadType=resumable&upload_id={upload_id}"
+            )
+            return "files.update", 200, {"Location": location}, b""
+        if upload_id is None:
+            content = body
+        else:
+            received = self.uploads[upload_id]
+            received.extend(body)
+            total = (headers.get("Content-Range") or "").rpartition("/")[2]
+            if total.isdigit() and len(received) < int(total):
+                return (
+                    "files.upload",
+                    308,
+                    {"Range": f"bytes=0-{len(received) - 1}"},
+                    b"",
+                )
+            content = bytes(self.uploads.pop(upload_id))
+        file = self.files[file_id]
+        file["content"] = content
+        self.touch(file_id)
+        return json_reply(
+            "files.upload" if upload_id else "files.update",
+            {key: value for key, value in file.items() if key != "content"},
+        )
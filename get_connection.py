@@ -1,25 +1,144 @@
 """
 get_connection.py
 A module that creates a connection to the PowerSchool API.
+
+All PowerSchool requests go through one pooled keep-alive session, and the access token
+is cached in keyring, next to the API credentials, and reused until it is close to
+expiring. Every request is recorded
+with `metrics.record_call`.
 """
 
 import base64
+import json
+import os
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 import keyring
-from constants import AUTH_URL
+import keyring.errors
+from metrics import record_call
+from constants import (
+    AUTH_URL,
+    FETCH_WORKERS,
+    HOST_CONCURRENCY,
+    PS_TOKEN_FILE,
+    TOKEN_REFRESH_MARGIN,
+)
+
+# Various other variables. PS_API_ID and PS_API_SECRET take the place of the keyring
+# entries when they are set.
+API_CLIENT_ID = os.environ.get("PS_API_ID") or keyring.get_password(
+    "PS-API-ID", "PS-API"
+)
+API_CLIENT_SECRET = os.environ.get("PS_API_SECRET") or keyring.get_password(
+    "PS-API-SECRET", "PS-API"
+)
+
+# The keyring entry the token is cached in. When the credentials come from the
+# environment, such as for the stand-ins in fake_services.py, or keyring has no backend,
+# the token goes in PS_TOKEN_FILE instead, readable only by its owner.
+TOKEN_KEYRING = ("PS-API-TOKEN", "PS-API")
+TOKEN_IN_KEYRING = not os.environ.get("PS_API_ID")
+
+# Enough pooled connections for every fetch that can be in flight at once.
+POOL_SIZE = max(FETCH_WORKERS, HOST_CONCURRENCY)
 
-# Various other variables.
-API_CLIENT_ID = keyring.get_password("PS-API-ID", "PS-API")
-API_CLIENT_SECRET = keyring.get_password("PS-API-SECRET", "PS-API")
+_session = None
+_session_lock = threading.Lock()
 
+# The cached token response, with an added "expires_at" time.
+_token = None
+_token_lock = threading.Lock()
 
-def get_connection():
+
+def get_session():
     """
-    Retrieves a connection to the API by sending a POST request to the AUTH_URL with the provided
-    API_CLIENT_ID and API_CLIENT_SECRET.
+    Returns the shared PowerSchool session, creating it the first time.
 
     Returns:
-        list: A list containing the access token and token type retrieved from the API response.
+        requests.Session: A keep-alive session with compression enabled and a connection
+        pool sized for the fetch concurrency.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            _session = session
+        return _session
+
+
+def token_valid(token):
+    """Return True if a cached token exists and is not close to expiring."""
+    return (
+        token is not None
+        and token.get("expires_at", 0) - TOKEN_REFRESH_MARGIN > time.time()
+    )
+
+
+def load_token():
+    """
+    Loads the cached token from keyring, or from PS_TOKEN_FILE if it isn't there.
+
+    Returns:
+        dict or None: The token if one is cached and can be read, otherwise None.
+    """
+    if TOKEN_IN_KEYRING:
+        try:
+            text = keyring.get_password(*TOKEN_KEYRING)
+            if text:
+                return json.loads(text)
+        except (keyring.errors.KeyringError, ValueError) as error:
+            print(f"An error occurred in load_token: {error}")
+    if not os.path.exists(PS_TOKEN_FILE):
+        return None
+    try:
+        with open(PS_TOKEN_FILE, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError) as error:
+        print(f"An error occurred in load_token: {error}")
+        return None
+
+
+def save_token(data):
+    """
+    Caches a token in keyring, or in PS_TOKEN_FILE with mode 0600 if keyring can't be
+    used.
+
+    Args:
+        data (dict): The token response, with its "expires_at" time.
+    """
+    text = json.dumps(data)
+    if TOKEN_IN_KEYRING:
+        try:
+            keyring.set_password(*TOKEN_KEYRING, text)
+            # A token cached in plain text by an older version isn't needed any more.
+            if os.path.exists(PS_TOKEN_FILE):
+                os.remove(PS_TOKEN_FILE)
+            return
+        except (keyring.errors.KeyringError, OSError) as error:
+            print(f"An error occurred in save_token, using {PS_TOKEN_FILE}: {error}")
+    # Each process writes its own temporary file, so runs started together don't
+    # clobber each other, and the file is never readable by others, even briefly.
+    temporary = f"{PS_TOKEN_FILE}.{os.getpid()}.tmp"
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(descriptor, 0o600)
+    with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(temporary, PS_TOKEN_FILE)
+
+
+def request_token():
+    """
+    Requests a new access token by sending a POST request to the AUTH_URL with the
+    provided API_CLIENT_ID and API_CLIENT_SECRET, and caches it.
+
+    Returns:
+        dict: The token response, with an added "expires_at" time.
     """
     headers = {
         "Authorization": "Basic "
@@ -29,8 +148,117 @@ def get_connection():
     }
     payload = {"grant_type": "client_credentials"}
 
-    response = requests.post(AUTH_URL, headers=headers, data=payload, timeout=10)
+    start = time.perf_counter()
+    response = get_session().post(AUTH_URL, headers=headers, data=payload, timeout=10)
+    record_call(
+        "powerschool",
+        "token",
+        time.perf_counter() - start,
+        received=len(response.content),
+        outcome="ok" if response.ok else "error",
+    )
     data = response.json()
-    str_access_token = data["access_token"]
-    local_token_type = data["token_type"]
-    return [str_access_token, local_token_type]
+    data["expires_at"] = time.time() + int(data.get("expires_in", 0))
+    save_token(data)
+    return data
+
+
+def get_connection(refresh=False):
+    """
+    Retrieves a connection to the API, reusing the cached token until it nears expiry.
+
+    Args:
+        refresh (bool): Whether to request a new token even if the cached one is valid.
+
+    Returns:
+        list: A list containing the access token and token type retrieved from the API response.
+    """
+    global _token
+    with _token_lock:
+        if _token is None and not refresh:
+            _token = load_token()
+        if refresh or not token_valid(_token):
+            _token = request_token()
+        return [_token["access_token"], _token["token_type"]]
+
+
+def refresh_connection(connection, stale_token):
+    """
+    Replaces the token in a connection after PowerSchool rejected it.
+
+    If another thread already refreshed the connection, the new token is kept.
+
+    Args:
+        connection (list): The access token and token type, updated in place.
+        stale_token (str): The access token that was rejected.
+    """
+    global _token
+    with _token_lock:
+        if connection[0] == stale_token:
+            _token = request_token()
+            connection[0] = _token["access_token"]
+            connection[1] = _token["token_type"]
+
+
+def ps_post(url, connection, payload, stream=False):
+    """
+    Sends a POST request to the PowerSchool API over the shared session.
+
+    If the token has expired and the request returns 401, the token is refreshed and
+    the request is sent once more.
+
+    Args:
+        url (str): The URL to post to.
+        connection (list): The access token and token type.
+        payload (dict): The JSON body.
+        stream (bool): Whether to stream the response body.
+
+    Returns:
+        requests.Response: The response.
+    """
+    if url.split("?")[0].endswith("/count"):
+        endpoint = "query.count"
+    else:
+        endpoint = "query.page" if "page=" in url else "query"
+    body = json.dumps(payload)
+    start = time.perf_counter()
+    for attempt in range(2):
+        token = connection[0]
+        headers = {
+            "Authorization": connection[1] + " " + token,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        response = get_session().post(
+            url, headers=headers, data=body, timeout=10, stream=stream
+        )
+        if response.status_code != 401 or attempt:
+            break
+        response.close()
+        refresh_connection(connection, token)
+
+    def record():
+        record_call(
+            "powerschool",
+            endpoint,
+            time.perf_counter() - start,
+            len(body),
+            response.raw.tell() if stream else len(response.content),
+            attempt,
+            "ok" if response.ok else "error",
+        )
+
+    if stream:
+        # A streamed body is read after this returns, so the call is recorded once the
+        # caller closes the response.
+        close = response.close
+
+        def close_and_record():
+            response.close = close
+            record()
+            close()
+
+        response.close = close_and_record
+    else:
+        record()
+    return response
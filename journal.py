@@ -0,0 +1,166 @@
+"""
+This module contains the run journal that lets api_writer and copy_files resume.
+
+The journal is a JSON lines file that gets one line for every unit of work as soon as
+it is finished: a (school, query) for api_writer, or a (school, folder, format, tab)
+for copy_files. Each line is flushed to disk before the run moves on, so it survives
+the process dying. A run started with --resume reads the journal of the run before it
+and skips the units that run finished. A run that finishes every unit deletes its
+journal, so the next run starts from scratch.
+
+Only one run at a time can use a journal. Where fcntl is available the journal is
+locked for the whole run, and a second run of the same script in the same directory,
+such as cron overlapping the daemon, stops with `JournalBusy` instead of truncating the
+first run's journal.
+"""
+
+import json
+import os
+import threading
+import time
+from constants import JOURNAL_FILE
+from manifest import manifest_key
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# The exit status of a script that stopped because another run holds its journal, so
+# callers such as the stress test runner can tell it from a failed run.
+BUSY_EXIT = 75
+
+
+class JournalBusy(RuntimeError):
+    """Raised when another run is already using a journal."""
+
+
+class Journal:
+    """
+    The finished units of a run, kept in memory and appended to the journal file.
+
+    Used as a context manager, the journal is closed and its lock released when the
+    block exits, even if the run raised. A run that didn't get to call `finish` keeps
+    its journal for --resume.
+    """
+
+    def __init__(self, script, resume=False, path=None):
+        """
+        Opens the journal for a script.
+
+        Args:
+            script (str): The script the run is for, such as "api_writer".
+            resume (bool): Keep the units the last run finished instead of starting
+            over.
+            path (str, optional): The journal file. Defaults to JOURNAL_FILE for the
+            script.
+
+        Raises:
+            JournalBusy: If another run holds the journal's lock.
+        """
+        self.path = path or JOURNAL_FILE.format(script)
+        self.finished = set()
+        self.closed = False
+        self._lock = threading.Lock()
+        # The lock file is held until `finish`, or until the process exits.
+        # pylint: disable-next=consider-using-with
+        self._run_lock = open(self.path + ".lock", "a", encoding="utf-8")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._run_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError as error:
+                self._run_lock.close()
+                raise JournalBusy(
+                    f"Another {script} run is using {self.path}, not starting."
+                ) from error
+        if resume:
+            self.finished = read_journal(self.path)
+            print(f"Resuming {script}: {len(self.finished)} units already finished.")
+        # The file stays open for the whole run and is closed by `finish`.
+        # pylint: disable-next=consider-using-with
+        self._file = open(self.path, "a" if resume else "w", encoding="utf-8")
+        self._write({"script": script, "started": time.strftime("%m-%d-%Y %I:%M %p")})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.closed:
+            self.finish(False)
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def done(self, *unit):
+        """Return True if the unit was finished by this run or the one it resumes."""
+        return manifest_key(*unit) in self.finished
+
+    def record(self, *unit):
+        """
+        Marks a unit as finished and writes it to disk before returning.
+
+        A unit finished by a worker still running after the journal was closed, such as
+        when the run raised, isn't recorded, and --resume does it again.
+
+        Args:
+            *unit: The parts that name the unit, such as the school ID and query name.
+        """
+        key = manifest_key(*unit)
+        with self._lock:
+            if self.closed or key in self.finished:
+                return
+            self.finished.add(key)
+            self._write({"unit": key, "at": time.strftime("%m-%d-%Y %I:%M %p")})
+
+    def finish(self, complete):
+        """
+        Closes the journal.
+
+        Args:
+            complete (bool): Whether every unit of the run was finished. If so the
+            journal is deleted, otherwise it is kept for --resume.
+        """
+        with self._lock:
+            self.closed = True
+            self._file.close()
+        try:
+            if complete:
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+            else:
+                print(f"Run incomplete, use --resume to pick up from {self.path}.")
+        finally:
+            self._run_lock.close()
+
+
+def read_journal(path):
+    """
+    Reads the finished units from a journal file.
+
+    Args:
+        path (str): The journal file.
+
+    Returns:
+        set: The keys of the finished units, empty if there is no journal. A line cut
+        off by a crash is ignored.
+    """
+    finished = set()
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if "unit" in entry:
+                    finished.add(entry["unit"])
+    except FileNotFoundError:
+        pass
+    except OSError as error:
+        print(f"An error occurred in read_journal, starting fresh: {error}")
+    return finished
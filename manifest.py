@@ -0,0 +1,169 @@
+"""
+This module contains functions for the change manifest shared by api_writer and copy_files.
+
+The manifest is a JSON file that remembers what was written on earlier runs:
+- "rows": a hash of the rows api_writer last wrote to each (spreadsheet, tab).
+- "written": the Drive modifiedTime of each spreadsheet right after api_writer wrote it.
+- "sources": the Drive modifiedTime last seen for each source spreadsheet.
+- "pushed": the source modifiedTime last copied to each (spreadsheet, folder, format).
+
+Several processes, such as the shards of a split run, can share one manifest. Each of
+them only writes the entries it changed, see `save_manifest`.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from constants import MANIFEST_FILE
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+_manifest_lock = threading.Lock()
+
+# The sections of the manifest, each a dict of entries.
+SECTIONS = ("rows", "written", "sources", "pushed")
+
+
+def load_manifest(path=MANIFEST_FILE):
+    """
+    Loads the manifest from disk.
+
+    Args:
+        path (str): The path of the manifest file.
+
+    Returns:
+        dict: The manifest, or an empty one if the file is missing or unreadable.
+    """
+    manifest = {section: {} for section in SECTIONS}
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                manifest.update(json.load(file))
+        except (OSError, ValueError) as error:
+            print(f"An error occurred in load_manifest, starting fresh: {error}")
+    # The (section, key) pairs changed since loading, which aren't saved to the file.
+    manifest["changed"] = set()
+    return manifest
+
+
+def save_manifest(manifest, path=MANIFEST_FILE):
+    """
+    Writes the manifest to disk, replacing the old file in one step.
+
+    The file is read again first and only the entries changed since `manifest` was
+    loaded are written over it, so entries saved by other processes in the meantime
+    are kept. The loaded manifest is brought up to date with them as well. Where fcntl
+    is available a lock file keeps two processes from saving at the same time.
+
+    Args:
+        manifest (dict): The manifest to save.
+        path (str): The path of the manifest file.
+    """
+    with _manifest_lock, open(path + ".lock", "a", encoding="utf-8") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        current = load_manifest(path)
+        for section, key in manifest.setdefault("changed", set()):
+            current[section][key] = manifest[section][key]
+        manifest["changed"].clear()
+        for section in SECTIONS:
+            manifest[section] = current[section]
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(
+                {section: current[section] for section in SECTIONS},
+                file,
+                indent=2,
+                sort_keys=True,
+            )
+        os.replace(temp_path, path)
+
+
+def manifest_key(*parts):
+    """Return the manifest key for the given parts."""
+    return "|".join(str(part) for part in parts)
+
+
+def hash_rows(rows):
+    """Return a hash of the contents of a list of rows."""
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update(json.dumps(row, default=str).encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def rows_unchanged(manifest, spreadsheet_id, sheet_name, rows, modified_time):
+    """
+    Checks if the rows for a tab are the same as the ones written last time.
+
+    The rows only count as unchanged if the spreadsheet hasn't been modified since
+    api_writer wrote it either, so a tab that was edited, sorted or cleared by hand is
+    written again.
+
+    Args:
+        manifest (dict): The loaded manifest.
+        spreadsheet_id (str): The ID of the spreadsheet.
+        sheet_name (str): The name of the tab.
+        rows (list): The rows about to be written.
+        modified_time (str or None): The spreadsheet's current Drive modifiedTime.
+
+    Returns:
+        bool: True if the same rows were written last time and are still there.
+    """
+    if modified_time is None:
+        return False
+    if manifest["written"].get(spreadsheet_id) != modified_time:
+        return False
+    key = manifest_key(spreadsheet_id, sheet_name)
+    return manifest["rows"].get(key) == hash_rows(rows)
+
+
+def record_rows(manifest, spreadsheet_id, sheet_name, rows):
+    """Remember the hash of the rows written to a tab."""
+    key = manifest_key(spreadsheet_id, sheet_name)
+    with _manifest_lock:
+        manifest["rows"][key] = hash_rows(rows)
+        manifest.setdefault("changed", set()).add(("rows", key))
+
+
+def record_write(manifest, spreadsheet_id, modified_time):
+    """Remember a spreadsheet's modifiedTime right after api_writer wrote it."""
+    with _manifest_lock:
+        manifest["written"][spreadsheet_id] = modified_time
+        manifest.setdefault("changed", set()).add(("written", spreadsheet_id))
+
+
+def push_unchanged(manifest, spreadsheet_id, folder_id, format_name, modified_time):
+    """
+    Checks if a destination already holds the current version of a source spreadsheet.
+
+    Args:
+        manifest (dict): The loaded manifest.
+        spreadsheet_id (str): The ID of the source spreadsheet.
+        folder_id (str): The ID of the destination folder.
+        format_name (str): The name of the file format.
+        modified_time (str or None): The source's current Drive modifiedTime.
+
+    Returns:
+        bool: True if this version was already pushed to the destination.
+    """
+    if modified_time is None:
+        return False
+    key = manifest_key(spreadsheet_id, folder_id, format_name)
+    return manifest["pushed"].get(key) == modified_time
+
+
+def record_push(manifest, spreadsheet_id, folder_id, format_name, modified_time):
+    """Remember which version of a source was pushed to a destination."""
+    key = manifest_key(spreadsheet_id, folder_id, format_name)
+    with _manifest_lock:
+        manifest["sources"][spreadsheet_id] = modified_time
+        manifest["pushed"][key] = modified_time
+        manifest.setdefault("changed", set()).update(
+            {("sources", spreadsheet_id), ("pushed", key)}
+        )
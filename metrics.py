@@ -0,0 +1,301 @@
+"""
+This module records how long every API call and every stage of a run takes.
+
+Calls are recorded by `request_executor.execute` for Google and by `ps_post` for
+PowerSchool, and stages by wrapping work in `stage`. Both are labelled with the school
+and the query or format of the stage they run in, which is tracked per thread. At the
+end of a run `write_metrics` saves a JSON summary and a Prometheus textfile, for the
+node_exporter textfile collector, to METRICS_DIR.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from constants import METRICS_DIR, LATENCY_BUCKETS
+
+_local = threading.local()
+_lock = threading.Lock()
+
+# The labels of a call and of a stage, in the order of their keys.
+CALL_LABELS = ("service", "endpoint", "school", "item", "outcome")
+STAGE_LABELS = ("stage", "school", "item", "outcome")
+
+# Aggregated calls keyed by their CALL_LABELS values.
+_calls = {}
+
+# Aggregated stages keyed by their STAGE_LABELS values.
+_stages = {}
+
+_run = {"started": time.time()}
+
+
+def start_run():
+    """Forget everything recorded so far and start timing a new run."""
+    with _lock:
+        _calls.clear()
+        _stages.clear()
+        _run["started"] = time.time()
+
+
+def current_labels():
+    """Return the school and item labels of the stage the calling thread is in."""
+    return getattr(_local, "labels", {})
+
+
+def new_entry():
+    """Return an empty aggregate for a call or stage key."""
+    return {
+        "count": 0,
+        "seconds": 0.0,
+        "max_seconds": 0.0,
+        "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+        "bytes_sent": 0,
+        "bytes_received": 0,
+        "retries": 0,
+    }
+
+
+def observe(entry, seconds):
+    """Add a duration to an aggregate."""
+    entry["count"] += 1
+    entry["seconds"] += seconds
+    entry["max_seconds"] = max(entry["max_seconds"], seconds)
+    for index, bound in enumerate(LATENCY_BUCKETS):
+        if seconds <= bound:
+            entry["buckets"][index] += 1
+            return
+    entry["buckets"][-1] += 1
+
+
+def record_call(
+    service, endpoint, seconds, sent=0, received=0, retries=0, outcome="ok"
+):
+    """
+    Records one API call, labelled with the stage the calling thread is in.
+
+    Args:
+        service (str): "powerschool", "sheets" or "drive".
+        endpoint (str): The call, such as "batch_get_values" or "query.page".
+        seconds (float): How long the call took, retries included.
+        sent (int): The bytes sent.
+        received (int): The bytes received.
+        retries (int): The attempts made after the first one.
+        outcome (str): "ok" or "error".
+    """
+    labels = current_labels()
+    school, item = labels.get("school", ""), labels.get("item", "")
+    key = (service, endpoint, school, item, outcome)
+    with _lock:
+        entry = _calls.setdefault(key, new_entry())
+        observe(entry, seconds)
+        entry["bytes_sent"] += sent
+        entry["bytes_received"] += received
+        entry["retries"] += retries
+
+
+def carry_labels(function):
+    """
+    Wraps a function so it keeps the calling thread's labels when run on another thread.
+
+    Args:
+        function: The function to hand to a worker pool.
+
+    Returns:
+        function: The wrapped function.
+    """
+    labels = current_labels()
+
+    def run(*args, **kwargs):
+        outer = current_labels()
+        _local.labels = labels
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.labels = outer
+
+    return run
+
+
+@contextlib.contextmanager
+def stage(name, school=None, item=None):
+    """
+    Times a stage of the run, such as fetching a query or uploading a file.
+
+    Calls made by the calling thread inside the stage are labelled with its school and
+    item. Stages can be nested, and labels not given are kept from the outer stage.
+
+    Args:
+        name (str): The stage, such as "fetch", "write" or "export".
+        school (optional): The school ID the stage works on.
+        item (str, optional): The query sheet name or file format the stage works on.
+    """
+    outer = current_labels()
+    labels = dict(outer)
+    if school is not None:
+        labels["school"] = str(school)
+    if item is not None:
+        labels["item"] = str(item)
+    _local.labels = labels
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        _local.labels = outer
+        seconds = time.perf_counter() - start
+        key = (name, labels.get("school", ""), labels.get("item", ""), outcome)
+        with _lock:
+            observe(_stages.setdefault(key, new_entry()), seconds)
+
+
+def summary(script):
+    """
+    Returns everything recorded in the run as a dict that can be saved as JSON.
+
+    Args:
+        script (str): The script the run was for, such as "api_writer".
+
+    Returns:
+        dict: The run's totals and the calls and stages with their labels.
+    """
+    with _lock:
+        calls = [
+            dict(zip(CALL_LABELS, key), **entry)
+            for key, entry in sorted(_calls.items())
+        ]
+        stages = [
+            dict(zip(STAGE_LABELS, key), **entry)
+            for key, entry in sorted(_stages.items())
+        ]
+    return {
+        "script": script,
+        "started": _run["started"],
+        "seconds": time.time() - _run["started"],
+        "calls": sum(call["count"] for call in calls),
+        "errors": sum(call["count"] for call in calls if call["outcome"] != "ok"),
+        "retries": sum(call["retries"] for call in calls),
+        "bytes_sent": sum(call["bytes_sent"] for call in calls),
+        "bytes_received": sum(call["bytes_received"] for call in calls),
+        "latency_buckets": list(LATENCY_BUCKETS),
+        "api_calls": calls,
+        "stages": stages,
+    }
+
+
+def label_text(labels):
+    """Return Prometheus label pairs for a dict of labels."""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def histogram_lines(metric, labels, entry):
+    """Return the bucket, sum and count lines of one histogram series."""
+    lines = []
+    cumulative = 0
+    bounds = [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]
+    for bound, count in zip(bounds, entry["buckets"]):
+        cumulative += count
+        bucket_labels = label_text({**labels, "le": bound})
+        lines.append(f"{metric}_bucket{bucket_labels} {cumulative}")
+    lines.append(f"{metric}_sum{label_text(labels)} {entry['seconds']:.6f}")
+    lines.append(f"{metric}_count{label_text(labels)} {entry['count']}")
+    return lines
+
+
+def prometheus_text(run):
+    """
+    Returns a run summary in the Prometheus text exposition format.
+
+    Args:
+        run (dict): The summary from `summary`.
+
+    Returns:
+        str: The textfile contents.
+    """
+    script = {"script": run["script"]}
+    lines = [
+        "# HELP ps_backup_api_call_duration_seconds Time spent in API calls.",
+        "# TYPE ps_backup_api_call_duration_seconds histogram",
+    ]
+    for call in run["api_calls"]:
+        labels = dict(script, **{name: call[name] for name in CALL_LABELS})
+        lines.extend(
+            histogram_lines("ps_backup_api_call_duration_seconds", labels, call)
+        )
+    lines.append("# HELP ps_backup_api_bytes_total Bytes moved by API calls.")
+    lines.append("# TYPE ps_backup_api_bytes_total counter")
+    for call in run["api_calls"]:
+        labels = dict(script, **{name: call[name] for name in CALL_LABELS})
+        for direction in ("sent", "received"):
+            direction_labels = label_text(dict(labels, direction=direction))
+            lines.append(
+                f"ps_backup_api_bytes_total{direction_labels} "
+                f"{call['bytes_' + direction]}"
+            )
+    lines.append("# HELP ps_backup_api_retries_total Retries made by API calls.")
+    lines.append("# TYPE ps_backup_api_retries_total counter")
+    for call in run["api_calls"]:
+        labels = dict(script, **{name: call[name] for name in CALL_LABELS})
+        lines.append(
+            f"ps_backup_api_retries_total{label_text(labels)} {call['retries']}"
+        )
+    lines.append("# HELP ps_backup_stage_duration_seconds Time spent in each stage.")
+    lines.append("# TYPE ps_backup_stage_duration_seconds histogram")
+    for entry in run["stages"]:
+        labels = dict(script, **{name: entry[name] for name in STAGE_LABELS})
+        lines.extend(
+            histogram_lines("ps_backup_stage_duration_seconds", labels, entry)
+        )
+    lines.extend(
+        [
+            "# HELP ps_backup_run_duration_seconds How long the last run took.",
+            "# TYPE ps_backup_run_duration_seconds gauge",
+            f"ps_backup_run_duration_seconds{label_text(script)} {run['seconds']:.3f}",
+            "# HELP ps_backup_run_timestamp_seconds When the last run finished.",
+            "# TYPE ps_backup_run_timestamp_seconds gauge",
+            f"ps_backup_run_timestamp_seconds{label_text(script)} "
+            f"{run['started'] + run['seconds']:.0f}",
+            "# HELP ps_backup_run_errors The API calls that failed in the last run.",
+            "# TYPE ps_backup_run_errors gauge",
+            f"ps_backup_run_errors{label_text(script)} {run['errors']}",
+        ]
+    )
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(script, directory=METRICS_DIR):
+    """
+    Saves the run's JSON summary and Prometheus textfile, replacing the last ones.
+
+    Args:
+        script (str): The script the run was for, such as "api_writer".
+        directory (str): Where to write the files.
+
+    Returns:
+        dict: The summary that was written.
+    """
+    run = summary(script)
+    os.makedirs(directory, exist_ok=True)
+    files = {
+        f"{script}.json": json.dumps(run, indent=2),
+        f"ps_backup_{script}.prom": prometheus_text(run),
+    }
+    for name, text in files.items():
+        # The textfile collector may read at any time, so each file is swapped in whole.
+        path = os.path.join(directory, name)
+        with open(path + ".tmp", "w", encoding="utf-8") as file:
+            file.write(text)
+        os.replace(path + ".tmp", path)
+    print(
+        f"{script}: {run['calls']} API calls, {run['retries']} retries, "
+        f"{run['errors']} errors in {run['seconds']:.1f}s. Metrics in {directory}."
+    )
+    return run
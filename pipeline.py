@@ -0,0 +1,117 @@
+"""
+This module runs api_writer and copy_files as one pipeline.
+
+Run one after the other, copy_files reads every tab api_writer just wrote back out of
+the primary spreadsheet before it can mirror or render it. The pipeline keeps the rows
+api_writer fetched in memory instead: as soon as a school's spreadsheet is written, the
+same rows go to its mirror sheets and XLSX and PDF files on a thread of their own, while
+the next schools are still being fetched and written. Only tabs the run didn't fetch,
+such as those left out with --query, or whose write failed, are read back. Exports that
+Drive builds still come from the written spreadsheet.
+
+Both halves share one journal and one manifest, so --resume picks up where either of
+them stopped.
+
+Example:
+    python pipeline.py
+    python pipeline.py --school 5 --format sheet
+    python pipeline.py --query "Transportation Info"
+    python pipeline.py --shard 2/3 --resume
+"""
+
+import argparse
+from constants import SCHOOLS, QUERIES, FILE_FORMATS
+from create_service import worker_pool
+from sheet_functions import add_header, normalize_row
+from manifest import load_manifest, save_manifest
+from metrics import start_run, write_metrics
+from journal import Journal, JournalBusy, BUSY_EXIT
+from shards import add_arguments, selection, run_name, finish_shard
+import api_writer
+import copy_files
+
+
+def sheet_values(query, rows):
+    """
+    Returns a query's rows the way copy_files would read them back from the sheet.
+
+    Args:
+        query (dict): The entry from QUERIES.
+        rows (list): The rows written for the query, without the header.
+
+    Returns:
+        list: The header and the rows as strings. Like the Sheets API, empty cells at
+        the end of a row are left off.
+    """
+    values = []
+    for row in rows:
+        cells = normalize_row(row, 0)
+        while cells and cells[-1] == "":
+            cells.pop()
+        values.append(cells)
+    return add_header(values, query.get("columns"))
+
+
+def main(
+    resume=False, schools=SCHOOLS, queries=QUERIES, formats=FILE_FORMATS, shard=None
+):
+    """
+    Fetches the queries, writes each school's spreadsheet and pushes it to its folders.
+
+    Schools are handed to a copy thread one at a time as their writes finish, so their
+    mirrors and exports go out while api_writer's writer thread moves on to the next
+    school. The (school, query) pairs and the files pushed go in the same run journal.
+
+    Parameters:
+        resume (bool): Whether to pick up where the last, unfinished run stopped.
+        schools (list): The SCHOOLS entries to write and copy.
+        queries (list): The QUERIES entries to fetch. Every tab is still copied.
+        formats (list): The FILE_FORMATS entries to copy them to.
+        shard (tuple, optional): The shard number and count, which name the run's
+        journal and metrics.
+    """
+    start_run()
+    name = run_name("pipeline", shard)
+    with Journal(name, resume) as journal:
+        manifest = load_manifest()
+        run = copy_files.CopyRun(manifest, journal, formats)
+        # CopyRun handles one school at a time, and copy_files' services can only be
+        # used from one thread, so the copies go through a single thread of their own.
+        copier = worker_pool("copy", 1)
+        copies = []
+
+        def copy_school(school, results):
+            # A tab whose write failed is not in the journal, and is read back instead.
+            fresh = {
+                query.get("sheetName"): sheet_values(query, rows)
+                for query, rows in results
+                if journal.done(school.get("schoolid"), query.get("sheetName"))
+            }
+            copies.append(copier.submit(run.copy_school, school, fresh))
+
+        written = api_writer.write_all(
+            schools, queries, manifest, journal, after_write=copy_school
+        )
+        for future in copies:
+            future.result()
+        copied = run.finish()
+        save_manifest(manifest)
+        complete = written and copied
+        journal.finish(complete)
+    finish_shard("pipeline", shard, complete)
+    write_metrics(name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Back up PowerQueries and copy them.")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the queries and files the last, unfinished run already finished.",
+    )
+    add_arguments(parser, queries=True, formats=True)
+    args = parser.parse_args()
+    try:
+        main(resume=args.resume, **selection(parser, args, "pipeline"))
+    except JournalBusy as error:
+        parser.exit(BUSY_EXIT, f"{error}\n")
@@ -0,0 +1,267 @@
+"""
+This module contains functions for rendering XLSX and PDF files locally from sheet rows.
+
+Only the standard library is used, so the files can be built on any worker without
+calling the Drive export endpoint. Both renderers take the same values the Sheets API
+returns for a tab: the header row first, then the data rows.
+"""
+
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+from sheet_functions import column_letter
+
+# Characters that are not allowed in XML text.
+_INVALID_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# Characters that are not allowed in an Excel sheet name.
+_INVALID_SHEET_NAME = re.compile(r"[\[\]:*?/\\]")
+
+# Landscape US letter, in points.
+PAGE_WIDTH = 792
+PAGE_HEIGHT = 612
+PAGE_MARGIN = 36
+
+# Widest a PDF column may get, in characters, before its cells are cut off.
+MAX_COLUMN_CHARS = 30
+
+# Courier glyphs are 0.6 of the font size wide.
+COURIER_WIDTH = 0.6
+
+
+def xlsx_cell(value, reference):
+    """
+    Returns the SpreadsheetML for one cell.
+
+    Parameters:
+        value: The cell value.
+        reference (str): The A1 reference of the cell.
+
+    Returns:
+        str: The <c> element, or an empty string for an empty cell.
+    """
+    if value is None or value == "":
+        return ""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c r="{reference}"><v>{value}</v></c>'
+    text = escape(_INVALID_XML.sub("", str(value)))
+    return (
+        f'<c r="{reference}" t="inlineStr">'
+        f'<is><t xml:space="preserve">{text}</t></is></c>'
+    )
+
+
+def xlsx_sheet(values):
+    """
+    Returns the worksheet XML for the rows of one tab.
+
+    Parameters:
+        values (list): The rows of the tab, header first.
+
+    Returns:
+        str: The worksheet XML.
+    """
+    rows = []
+    for row_number, row in enumerate(values, start=1):
+        cells = "".join(
+            xlsx_cell(value, column_letter(column) + str(row_number))
+            for column, value in enumerate(row, start=1)
+        )
+        rows.append(f'<row r="{row_number}">{cells}</row>')
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" '
+        'activePane="bottomLeft" state="frozen"/></sheetView></sheetViews>'
+        f'<sheetData>{"".join(rows)}</sheetData></worksheet>'
+    )
+
+
+def render_xlsx(tabs):
+    """
+    Builds an XLSX workbook with one worksheet per tab.
+
+    Parameters:
+        tabs (list): (sheet name, values) pairs, where values is the header row followed by
+        the data rows.
+
+    Returns:
+        bytes: The XLSX file.
+    """
+    sheets = "".join(
+        f'<sheet name="{escape(_INVALID_SHEET_NAME.sub("", name)[:31])}" '
+        f'sheetId="{number}" r:id="rId{number}"/>'
+        for number, (name, _) in enumerate(tabs, start=1)
+    )
+    relationships = "".join(
+        f'<Relationship Id="rId{number}" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        f'Target="worksheets/sheet{number}.xml"/>'
+        for number in range(1, len(tabs) + 1)
+    )
+    overrides = "".join(
+        f'<Override PartName="/xl/worksheets/sheet{number}.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        for number in range(1, len(tabs) + 1)
+    )
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as workbook:
+        workbook.writestr(
+            "[Content_Types].xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" '
+            'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            f"{overrides}</Types>",
+        )
+        workbook.writestr(
+            "_rels/.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/></Relationships>',
+        )
+        workbook.writestr(
+            "xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f"<sheets>{sheets}</sheets></workbook>",
+        )
+        workbook.writestr(
+            "xl/_rels/workbook.xml.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f"{relationships}</Relationships>",
+        )
+        for number, (_, values) in enumerate(tabs, start=1):
+            workbook.writestr(f"xl/worksheets/sheet{number}.xml", xlsx_sheet(values))
+    return output.getvalue()
+
+
+def pdf_text(text):
+    """
+    Returns text as an escaped PDF string literal in WinAnsi encoding.
+
+    Parameters:
+        text (str): The text of one line.
+
+    Returns:
+        bytes: The string literal.
+
+    Raises:
+        ValueError: If the text has characters WinAnsi doesn't have, such as Vietnamese
+        or Chinese names. The standard fonts can't show them, so the caller exports the
+        file from Drive instead of replacing them with question marks.
+    """
+    try:
+        data = str(text).encode("cp1252")
+    except UnicodeEncodeError as error:
+        raise ValueError(f"{text!r} can't be set in a standard PDF font") from error
+    data = data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+    return b"(" + data + b")"
+
+
+def format_line(row, widths):
+    """Return a row as one line of fixed width columns."""
+    cells = []
+    for column, width in enumerate(widths):
+        value = row[column] if column < len(row) and row[column] is not None else ""
+        cells.append(str(value)[:width].ljust(width))
+    return "  ".join(cells).rstrip()
+
+
+def render_pdf(title, values):
+    """
+    Builds a paginated PDF table for one tab.
+
+    The table is set in Courier so columns line up, sized so every column fits across a
+    landscape letter page, and the header row is repeated on each page.
+
+    Parameters:
+        title (str): The title printed at the top of each page.
+        values (list): The rows of the tab, header first.
+
+    Returns:
+        bytes: The PDF file.
+
+    Raises:
+        ValueError: If a line has text the standard fonts can't show, see `pdf_text`.
+    """
+    header = values[0] if values else []
+    rows = values[1:]
+    column_count = max([len(row) for row in values] + [1])
+    widths = [
+        max(
+            [len(str(row[column])) for row in values if column < len(row)] + [1]
+        )
+        for column in range(column_count)
+    ]
+    widths = [min(width, MAX_COLUMN_CHARS) for width in widths]
+    line_chars = sum(widths) + 2 * (column_count - 1)
+    usable_width = PAGE_WIDTH - 2 * PAGE_MARGIN
+    font_size = min(9.0, usable_width / (line_chars * COURIER_WIDTH))
+    line_height = font_size * 1.25
+    # The title and the header row take two lines at the top of each page.
+    rows_per_page = max(int((PAGE_HEIGHT - 2 * PAGE_MARGIN) / line_height) - 3, 1)
+    pages = [
+        rows[start : start + rows_per_page]
+        for start in range(0, max(len(rows), 1), rows_per_page)
+    ]
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # The page tree, filled in once the pages are numbered.
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier "
+        b"/Encoding /WinAnsiEncoding >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier-Bold "
+        b"/Encoding /WinAnsiEncoding >>",
+    ]
+    page_ids = []
+    for page_number, page_rows in enumerate(pages, start=1):
+        top = PAGE_HEIGHT - PAGE_MARGIN - font_size
+        lines = [
+            (b"/F2", f"{title} - Page {page_number} of {len(pages)}"),
+            (b"/F2", format_line(header, widths)),
+        ] + [(b"/F1", format_line(row, widths)) for row in page_rows]
+        stream = [b"BT"]
+        for number, (font, line) in enumerate(lines):
+            y = top - number * line_height - (line_height if number else 0)
+            stream.append(b"%s %.2f Tf" % (font, font_size))
+            stream.append(b"1 0 0 1 %d %.2f Tm" % (PAGE_MARGIN, y))
+            stream.append(pdf_text(line) + b" Tj")
+        stream.append(b"ET")
+        content = b"\n".join(stream)
+        objects.append(
+            b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream"
+        )
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] "
+            b"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents %d 0 R >>"
+            % (PAGE_WIDTH, PAGE_HEIGHT, content_id)
+        )
+        page_ids.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    output = io.BytesIO()
+    output.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(output.tell())
+        output.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref = output.tell()
+    output.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        output.write(b"%010d 00000 n \n" % offset)
+    output.write(
+        b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+        % (len(objects) + 1, xref)
+    )
+    return output.getvalue()
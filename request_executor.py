@@ -0,0 +1,199 @@
+"""
+This module contains the shared executor every Sheets and Drive request goes through.
+
+Each API gets a limiter that combines a token bucket, tuned to the per-minute quota,
+with a cap on requests in flight. When Google answers 429 the limiter halves its rate
+and its concurrency, and it grows them back slowly as requests succeed. Failed requests
+are retried with exponential backoff and jitter, honoring Retry-After when it is sent.
+Every call is recorded with `metrics.record_call`.
+"""
+
+import random
+import socket
+import threading
+import time
+from googleapiclient.errors import HttpError
+from metrics import record_call
+from constants import (
+    SHEETS_READS_PER_MINUTE,
+    SHEETS_WRITES_PER_MINUTE,
+    DRIVE_REQUESTS_PER_MINUTE,
+    GOOGLE_MAX_CONCURRENCY,
+    GOOGLE_MAX_ATTEMPTS,
+    BACKOFF_BASE,
+    BACKOFF_MAX,
+)
+
+# HTTP statuses worth retrying.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# 403 reasons Google uses for quota errors.
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+# Successful requests needed before a throttled limiter grows again.
+RECOVERY_STREAK = 20
+
+
+class ApiLimiter:
+    """
+    Limits the rate and concurrency of the requests to one API, adapting to 429s.
+    """
+
+    def __init__(self, service, per_minute, max_concurrency=GOOGLE_MAX_CONCURRENCY):
+        self.service = service
+        self.max_rate = per_minute / 60.0
+        self.rate = self.max_rate
+        self.tokens = min(per_minute, max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.in_flight = 0
+        self.streak = 0
+        self.updated = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        burst = max(self.max_rate, self.concurrency)
+        self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Wait for a token and a free slot, then take both."""
+        with self._condition:
+            while True:
+                self._refill()
+                if self.tokens >= 1 and self.in_flight < self.concurrency:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                wait = (1 - self.tokens) / self.rate if self.tokens < 1 else None
+                self._condition.wait(wait)
+
+    def release(self, throttled):
+        """
+        Give back a slot and adjust the limits.
+
+        Args:
+            throttled (bool): Whether the request was answered with a rate limit error.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.streak = 0
+                self.rate = max(self.rate / 2, self.max_rate / 32)
+                self.concurrency = max(self.concurrency // 2, 1)
+            else:
+                self.streak += 1
+                if self.streak >= RECOVERY_STREAK:
+                    self.streak = 0
+                    self.rate = min(self.rate * 1.25, self.max_rate)
+                    self.concurrency = min(self.concurrency + 1, self.max_concurrency)
+            self._condition.notify_all()
+
+
+SHEETS_READ = ApiLimiter("sheets", SHEETS_READS_PER_MINUTE)
+SHEETS_WRITE = ApiLimiter("sheets", SHEETS_WRITES_PER_MINUTE)
+DRIVE = ApiLimiter("drive", DRIVE_REQUESTS_PER_MINUTE)
+
+
+def is_rate_limited(error):
+    """Return True if an HttpError is a quota or rate limit error."""
+    status = error.resp.status
+    return status == 429 or (
+        status == 403 and any(reason in str(error) for reason in RATE_LIMIT_REASONS)
+    )
+
+
+def backoff_delay(attempt, error=None):
+    """
+    Returns how long to wait before the next attempt.
+
+    Args:
+        attempt (int): The number of attempts made so far.
+        error (HttpError, optional): The error that failed the last attempt.
+
+    Returns:
+        float: Seconds to wait. Retry-After wins when Google sends it, otherwise an
+        exponential delay with full jitter.
+    """
+    if error is not None:
+        retry_after = error.resp.get("retry-after")
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def execute(request, limiter, name="request", sent=None):
+    """
+    Runs a Google API request under a limiter, retrying it when that is worthwhile.
+
+    Args:
+        request: An HttpRequest, or a function taking no arguments that makes the call.
+        limiter (ApiLimiter): The limiter for the API, such as SHEETS_READ or DRIVE.
+        name (str): The name used in log messages and metrics.
+        sent (int, optional): The bytes the call sends. Worked out from the body of an
+        HttpRequest when not given.
+
+    Returns:
+        The response of the request.
+
+    Raises:
+        HttpError: If the request failed with an error that can't be retried, or still
+        failed after GOOGLE_MAX_ATTEMPTS attempts.
+    """
+    received = [0]
+    if callable(request):
+        call = request
+    else:
+        call = request.execute
+        if sent is None:
+            sent = len(request.body or b"")
+        postproc = request.postproc
+
+        def measure(response, content):
+            received[0] = len(content or b"")
+            return postproc(response, content)
+
+        request.postproc = measure
+    start = time.perf_counter()
+    attempt = 0
+
+    def record(outcome, size=0):
+        record_call(
+            limiter.service,
+            name,
+            time.perf_counter() - start,
+            sent or 0,
+            size,
+            attempt if outcome == "ok" else attempt - 1,
+            outcome,
+        )
+
+    while True:
+        limiter.acquire()
+        throttled = False
+        try:
+            result = call()
+            # Downloads return a SpillBuffer, which knows its own size.
+            record("ok", received[0] or getattr(result, "size", 0))
+            return result
+        except HttpError as error:
+            throttled = is_rate_limited(error)
+            attempt += 1
+            if attempt >= GOOGLE_MAX_ATTEMPTS or not (
+                throttled or error.resp.status in RETRY_STATUSES
+            ):
+                record("error")
+                raise
+            delay = backoff_delay(attempt, error)
+            print(f"{name} failed with {error.resp.status}, retrying in {delay:.1f}s")
+        except (socket.timeout, ConnectionError) as error:
+            attempt += 1
+            if attempt >= GOOGLE_MAX_ATTEMPTS:
+                record("error")
+                raise
+            delay = backoff_delay(attempt)
+            print(f"{name} failed with {error}, retrying in {delay:.1f}s")
+        finally:
+            limiter.release(throttled)
+        time.sleep(delay)
@@ -0,0 +1,387 @@
+"""
+This module picks the schools, queries and formats a run works on.
+
+Runs can be narrowed with --school, --query and --format, and split across workers
+with --shard i/N. Sharding works on whole schools. The split is balanced on the stage
+timings in the last metrics summaries for the script. Schools are spread with the
+longest processing time first rule, so one slow building shares a shard with the quick
+ones instead of holding up a whole batch.
+
+Every finished shard writes new timings, so working the split out again whenever a
+worker starts would give a late worker, or a shard rerun with --resume, a different
+split from the one its siblings used. The first worker saves the split in
+SHARD_PLAN_FILE instead, and the others use it until every shard has finished with it.
+The next run after that balances again on the latest timings. Workers on different
+machines must share the working directory to share the split.
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from constants import SCHOOLS, QUERIES, FILE_FORMATS, METRICS_DIR, SHARD_PLAN_FILE
+from snapshot import table_name
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# The stages whose time counts towards a school's cost, for each script.
+COST_STAGES = {
+    "api_writer": ("fetch", "write"),
+    "copy_files": ("school", "export", "upload"),
+    "pipeline": ("fetch", "write", "school", "export", "upload"),
+}
+
+
+def parse_shard(text):
+    """
+    Parses a --shard value.
+
+    Args:
+        text (str): The shard as "i/N", where i counts from 1 to N.
+
+    Returns:
+        tuple: The shard number and shard count.
+
+    Raises:
+        argparse.ArgumentTypeError: If the value isn't of the form i/N with 1 <= i <= N.
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", text)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"must look like 1/3, got {text!r}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def run_name(script, shard=None):
+    """Return the name a run's metrics and journal go under, such as api_writer_2of3."""
+    if shard is None:
+        return script
+    return f"{script}_{shard[0]}of{shard[1]}"
+
+
+def school_costs(script, directory=METRICS_DIR):
+    """
+    Reads how long each school took in the script's past runs.
+
+    Every summary the script wrote, sharded or not, is read, and the most recent one
+    that has a school wins.
+
+    Args:
+        script (str): The script, such as "api_writer".
+        directory (str): Where the metrics summaries are.
+
+    Returns:
+        dict: Seconds keyed by school ID as a string.
+    """
+    stages = COST_STAGES.get(script, ())
+    latest = {}
+    paths = glob.glob(os.path.join(directory, f"{script}.json"))
+    paths += glob.glob(os.path.join(directory, f"{script}_*of*.json"))
+    for path in sorted(paths):
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                run = json.load(file)
+        except (OSError, ValueError) as error:
+            print(f"An error occurred in school_costs: {error}")
+            continue
+        totals = {}
+        for entry in run.get("stages", []):
+            if entry.get("stage") in stages and entry.get("school"):
+                totals[entry["school"]] = (
+                    totals.get(entry["school"], 0.0) + entry["seconds"]
+                )
+        for school, seconds in totals.items():
+            if school not in latest or run["started"] > latest[school][0]:
+                latest[school] = (run["started"], seconds)
+    return {school: seconds for school, (_, seconds) in latest.items()}
+
+
+def assign_shards(schools, count, costs):
+    """
+    Splits schools into `count` shards of about the same total cost.
+
+    The most expensive school goes first, each to the shard with the least cost so far.
+    Ties go to the lower school ID and the lower shard, so the result only depends on
+    the inputs.
+
+    Args:
+        schools (list): The SCHOOLS entries to split.
+        count (int): The number of shards.
+        costs (dict): Seconds keyed by school ID as a string, from `school_costs`.
+        Schools with no history cost the average of the others.
+
+    Returns:
+        list: One list of SCHOOLS entries per shard, in SCHOOLS order.
+    """
+    known = [
+        costs[str(school.get("schoolid"))]
+        for school in schools
+        if str(school.get("schoolid")) in costs
+    ]
+    default = sum(known) / len(known) if known else 1.0
+
+    def cost(school):
+        return round(costs.get(str(school.get("schoolid")), default), 3)
+
+    loads = [0.0] * count
+    members = [[] for _ in range(count)]
+
+    def order(school):
+        return (-cost(school), school.get("schoolid"))
+
+    for school in sorted(schools, key=order):
+        index = min(range(count), key=lambda i: (loads[i], i))
+        loads[index] += cost(school)
+        members[index].append(school)
+    return [[school for school in schools if school in shard] for shard in members]
+
+
+def shard_plan(script, schools, count, path=None):
+    """
+    Returns the split of schools across shards that the script's workers share.
+
+    The saved split is used while some of its shards haven't finished. Otherwise, or if
+    it was made for other schools or another shard count, a new one is made with
+    `assign_shards` and saved. Where fcntl is available a lock file keeps two workers
+    starting together from both making one.
+
+    Args:
+        script (str): The script, such as "api_writer".
+        schools (list): The SCHOOLS entries to split.
+        count (int): The number of shards.
+        path (str, optional): The plan file. Defaults to SHARD_PLAN_FILE for the script.
+
+    Returns:
+        list: One list of SCHOOLS entries per shard, in SCHOOLS order.
+    """
+    path = path or SHARD_PLAN_FILE.format(script)
+    school_ids = [school.get("schoolid") for school in schools]
+    with open(path + ".lock", "a", encoding="utf-8") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        plan = read_plan(path)
+        if (
+            plan is None
+            or plan.get("count") != count
+            or plan.get("schools") != school_ids
+            or len(plan.get("finished", [])) >= count
+        ):
+            shards = assign_shards(schools, count, school_costs(script))
+            plan = {
+                "count": count,
+                "schools": school_ids,
+                "shards": [
+                    [school.get("schoolid") for school in shard] for shard in shards
+                ],
+                "finished": [],
+                "made": time.strftime("%m-%d-%Y %I:%M %p"),
+            }
+            write_plan(path, plan)
+    by_id = {school.get("schoolid"): school for school in schools}
+    return [[by_id[school_id] for school_id in shard] for shard in plan["shards"]]
+
+
+def finish_shard(script, shard, complete, path=None):
+    """
+    Marks a shard as done with the saved split, once it has finished every school.
+
+    A shard that didn't finish leaves the split in place, so it picks up the same
+    schools when it is run again with --resume.
+
+    Args:
+        script (str): The script, such as "api_writer".
+        shard (tuple or None): The shard number and count. Nothing is done if None.
+        complete (bool): Whether the shard finished every school.
+        path (str, optional): The plan file. Defaults to SHARD_PLAN_FILE for the script.
+    """
+    if shard is None or not complete:
+        return
+    path = path or SHARD_PLAN_FILE.format(script)
+    with open(path + ".lock", "a", encoding="utf-8") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        plan = read_plan(path)
+        if plan is None or plan.get("count") != shard[1]:
+            return
+        if shard[0] not in plan["finished"]:
+            plan["finished"].append(shard[0])
+            write_plan(path, plan)
+
+
+def read_plan(path):
+    """Return the saved shard plan, or None if there isn't a readable one."""
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        print(f"An error occurred in read_plan, making a new one: {error}")
+        return None
+
+
+def write_plan(path, plan):
+    """Save a shard plan, replacing the old file in one step."""
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(plan, file, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def select_schools(script, school_ids=None, shard=None):
+    """
+    Returns the schools a run works on.
+
+    Args:
+        script (str): The script, such as "api_writer", whose history balances shards.
+        school_ids (list, optional): Only these school IDs. Every school if None.
+        shard (tuple, optional): The shard number and count from `parse_shard`.
+
+    Returns:
+        list: The SCHOOLS entries, in SCHOOLS order.
+
+    Raises:
+        ValueError: If a school ID isn't in SCHOOLS.
+    """
+    schools = SCHOOLS
+    if school_ids:
+        wanted = {str(school_id) for school_id in school_ids}
+        unknown = wanted - {str(school.get("schoolid")) for school in SCHOOLS}
+        if unknown:
+            raise ValueError(f"unknown school IDs: {', '.join(sorted(unknown))}")
+        schools = [
+            school for school in SCHOOLS if str(school.get("schoolid")) in wanted
+        ]
+    if shard is not None:
+        number, count = shard
+        schools = shard_plan(script, schools, count)[number - 1]
+        print(
+            f"Shard {number}/{count}: schools "
+            f"{', '.join(str(school.get('schoolid')) for school in schools) or 'none'}."
+        )
+    return schools
+
+
+def select_queries(names=None):
+    """
+    Returns the queries a run works on.
+
+    Args:
+        names (list, optional): Sheet names, such as "Contact Info", or their snapshot
+        table names, such as contact_info. Case doesn't matter. Every query if None.
+
+    Returns:
+        list: The QUERIES entries, in QUERIES order.
+
+    Raises:
+        ValueError: If a name doesn't match any query.
+    """
+    if not names:
+        return QUERIES
+    wanted = {name.lower() for name in names}
+    selected = [
+        query
+        for query in QUERIES
+        if {query.get("sheetName").lower(), table_name(query)} & wanted
+    ]
+    matched = set()
+    for query in selected:
+        matched |= {query.get("sheetName").lower(), table_name(query)}
+    if wanted - matched:
+        raise ValueError(f"unknown queries: {', '.join(sorted(wanted - matched))}")
+    return selected
+
+
+def select_formats(names=None):
+    """
+    Returns the file formats a run works on.
+
+    Args:
+        names (list, optional): Format names, with or without the dot, such as "pdf",
+        ".xlsx" or "sheet". Every format if None.
+
+    Returns:
+        list: The FILE_FORMATS entries, in FILE_FORMATS order.
+
+    Raises:
+        ValueError: If a name doesn't match any format.
+    """
+    if not names:
+        return FILE_FORMATS
+    wanted = {name.lower().lstrip(".") for name in names}
+    selected = [
+        file_format
+        for file_format in FILE_FORMATS
+        if file_format.get("name").lstrip(".") in wanted
+    ]
+    unknown = wanted - {file_format.get("name").lstrip(".") for file_format in selected}
+    if unknown:
+        raise ValueError(f"unknown formats: {', '.join(sorted(unknown))}")
+    return selected
+
+
+def add_arguments(parser, queries=False, formats=False):
+    """
+    Adds the --school and --shard options, and --query or --format if asked.
+
+    Args:
+        parser (argparse.ArgumentParser): The script's parser.
+        queries (bool): Whether to add --query.
+        formats (bool): Whether to add --format.
+    """
+    parser.add_argument(
+        "--school",
+        action="append",
+        metavar="ID",
+        help="Only this school ID. Can be repeated.",
+    )
+    if queries:
+        parser.add_argument(
+            "--query",
+            action="append",
+            metavar="NAME",
+            help='Only this query, such as "Contact Info". Can be repeated.',
+        )
+    if formats:
+        parser.add_argument(
+            "--format",
+            action="append",
+            metavar="NAME",
+            help="Only this format: sheet, xlsx or pdf. Can be repeated.",
+        )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="I/N",
+        help="Only the schools in shard I of N, balanced on past run times.",
+    )
+
+
+def selection(parser, args, script):
+    """
+    Turns the selector options into keyword arguments for a script's main function.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser, used to report a bad selector.
+        args (argparse.Namespace): The parsed options from `add_arguments`.
+        script (str): The script, such as "api_writer", whose history balances shards.
+
+    Returns:
+        dict: The selected "schools", "shard", and "queries" or "formats" if the
+        parser has them.
+    """
+    try:
+        selected = {
+            "schools": select_schools(script, args.school, args.shard),
+            "shard": args.shard,
+        }
+        if hasattr(args, "query"):
+            selected["queries"] = select_queries(args.query)
+        if hasattr(args, "format"):
+            selected["formats"] = select_formats(args.format)
+    except ValueError as error:
+        parser.error(str(error))
+    return selected
@@ -2,8 +2,23 @@
 This module contains functions for interacting with Google Sheets.
 """
 
+import threading
 import time
 from googleapiclient.errors import HttpError
+from constants import METADATA_TTL, WRITE_BLOCK_BYTES, WRITE_WORKERS
+from create_service import thread_service, worker_pool
+from drive_functions import add_to_folder_index
+from metrics import carry_labels
+from request_executor import execute, SHEETS_READ, SHEETS_WRITE, DRIVE
+
+# Only the metadata the scripts use, instead of the whole spreadsheet resource.
+METADATA_FIELDS = (
+    "spreadsheetId,properties.title,sheets.properties(sheetId,title,index)"
+)
+
+# Spreadsheet metadata keyed by spreadsheet ID, as (time fetched, metadata).
+_metadata_cache = {}
+_metadata_lock = threading.Lock()
 
 
 def add_header(values, columns):
@@ -22,27 +37,137 @@ def add_header(values, columns):
     return [acolumns] + values
 
 
-def create_range(values, sheet_name):
+def column_letter(number):
+    """Return the A1 column letters for a 1-based column number."""
+    letters = ""
+    while number > 0:
+        number, remainder = divmod(number - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def normalize_row(row, width):
     """
-    Creates a range string for a Google Sheets API batch update.
+    Returns a row the way the Sheets API reads it back, so old and new rows compare equal.
 
     Args:
-        values (list): A list of lists representing the values in the sheet.
-        sheet_name (str): The name of the sheet.
+        row (list): The values of a row.
+        width (int): The number of cells to pad the row to.
 
     Returns:
-        str: A string representing the range of cells to be updated in the format
-        sheet_name!A1:column_widthrow_count.
+        list: The row as strings, padded with empty strings to `width`.
     """
+    cells = ["" if value is None else str(value) for value in row]
+    return cells + [""] * (width - len(cells))
 
-    column_width = len(values[0])
-    return sheet_name + "!A1:" + str(column_width) + str(len(values))
 
+def diff_rows(current, new, width):
+    """
+    Works out which data rows of a sheet must be written to turn `current` into `new`.
+
+    Rows are compared by position, so the sheet always keeps the query's order. A row
+    is only written if it differs from the row already in its place: changed values
+    cost one row each and new rows at the end are appended. A row added or removed part
+    way down shifts every row under it, so the tail from there on is rewritten in order.
+    The rows past the new end are blanked.
+
+    Args:
+        current (list): The data rows currently in the sheet, without the header.
+        new (list): The data rows that should be in the sheet, without the header.
+        width (int): The number of cells in a row.
 
-def get_ss_name(service, spreadsheet_id, count=0):
+    Returns:
+        dict: The rows to write keyed by data row index.
     """
-    Retrieves the title of a Google Sheets spreadsheet using the provided service and
-    spreadsheet ID.
+    changes = {}
+    for index, row in enumerate(new):
+        cells = normalize_row(row, width)
+        if index >= len(current) or normalize_row(current[index], width) != cells:
+            changes[index] = cells
+    for index in range(len(new), len(current)):
+        changes[index] = [""] * width
+    return changes
+
+
+def row_bytes(row):
+    """Return roughly how many bytes a row takes up in a JSON request body."""
+    return 2 + sum(len(str(value)) + 3 for value in row)
+
+
+def chunk_rows(sheet_name, first_row, rows, max_bytes=WRITE_BLOCK_BYTES):
+    """
+    Splits consecutive rows into values.batchUpdate ranges of about `max_bytes` each.
+
+    Args:
+        sheet_name (str): The name of the sheet.
+        first_row (int): The sheet row, counting from 1, the first of `rows` goes on.
+        rows (list): The rows to write.
+        max_bytes (int): The estimated size a block may grow to. A block always gets
+        at least one row.
+
+    Returns:
+        list: The `data` entries for a values.batchUpdate body, each with a range
+        covering exactly its rows and the widest of them.
+    """
+    data = []
+    start = 0
+    size = 0
+    for index, row in enumerate(rows):
+        cost = row_bytes(row)
+        if index > start and size + cost > max_bytes:
+            data.append(block_range(sheet_name, first_row, rows, start, index))
+            start, size = index, 0
+        size += cost
+    if start < len(rows):
+        data.append(block_range(sheet_name, first_row, rows, start, len(rows)))
+    return data
+
+
+def block_range(sheet_name, first_row, rows, start, end):
+    """Return the batchUpdate entry for rows[start:end], which begin on `first_row`."""
+    block = rows[start:end]
+    width = max(len(row) for row in block) or 1
+    first = first_row + start
+    last = first + len(block) - 1
+    return {
+        "range": f"'{sheet_name}'!A{first}:{column_letter(width)}{last}",
+        "values": block,
+    }
+
+
+def delta_ranges(sheet_name, changes):
+    """
+    Groups changed rows into contiguous A1 ranges for a values.batchUpdate.
+
+    Args:
+        sheet_name (str): The name of the sheet.
+        changes (dict): The rows to write keyed by data row index, from `diff_rows`.
+
+    Returns:
+        list: The `data` entries for a values.batchUpdate body.
+    """
+    data = []
+    start = None
+    block = []
+    for index in sorted(changes) + [None]:
+        if block and (index is None or index != start + len(block)):
+            # Data row 0 sits under the header, on sheet row 2.
+            data.extend(chunk_rows(sheet_name, start + 2, block))
+            block = []
+        if index is None:
+            break
+        if not block:
+            start = index
+        block.append(changes[index])
+    return data
+
+
+def get_metadata(service, spreadsheet_id):
+    """
+    Retrieves the title and sheet properties of a spreadsheet, using a shared cache.
+
+    The metadata is fetched with a `fields` mask and kept for METADATA_TTL seconds, or
+    until `invalidate_metadata` is called after a structural change.
 
     Args:
         service (googleapiclient.discovery.Resource): An authenticated Google Sheets
@@ -50,95 +175,201 @@ def get_ss_name(service, spreadsheet_id, count=0):
         spreadsheet_id (str): The ID of the Google Sheets spreadsheet.
 
     Returns:
-        str: The title of the spreadsheet if successful, or an error message if an
-        exception occurred.
+        dict: The spreadsheet metadata if successful, or None if it could not be read.
     """
+    with _metadata_lock:
+        cached = _metadata_cache.get(spreadsheet_id)
+    if cached and time.monotonic() - cached[0] < METADATA_TTL:
+        return cached[1]
     try:
-        if count >= 3:
-            print("Hit max retries for get_ss_name, returning None")
-            return None
-        result = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-        return result.get("properties").get("title")
+        result = execute(
+            service.spreadsheets().get(
+                spreadsheetId=spreadsheet_id, fields=METADATA_FIELDS
+            ),
+            SHEETS_READ,
+            "get_metadata",
+        )
+        with _metadata_lock:
+            _metadata_cache[spreadsheet_id] = (time.monotonic(), result)
+        return result
     except HttpError as error:
-        print(f"An error occurred: {error}")
-        get_ss_name(service, spreadsheet_id, count + 1)
+        print(f"An error occurred in get_metadata: {error}")
+        return None
 
 
-def update_values(
-    service, spreadsheet_id, range_name, value_input_option, _values, count=0
-):
+def invalidate_metadata(spreadsheet_id=None):
     """
-    Updates the values in a specified range of a Google Sheets spreadsheet.
+    Drops cached metadata so the next read fetches it again.
+
+    Args:
+        spreadsheet_id (str, optional): The spreadsheet to drop, or None to drop them all.
+    """
+    with _metadata_lock:
+        if spreadsheet_id is None:
+            _metadata_cache.clear()
+        else:
+            _metadata_cache.pop(spreadsheet_id, None)
+
+
+def get_ss_name(service, spreadsheet_id):
+    """
+    Retrieves the title of a Google Sheets spreadsheet using the provided service and
+    spreadsheet ID.
 
     Args:
         service (googleapiclient.discovery.Resource): An authenticated Google Sheets
         API service object.
         spreadsheet_id (str): The ID of the Google Sheets spreadsheet.
-        range_name (str): The range of cells to update.
+
+    Returns:
+        str: The title of the spreadsheet if successful, or None if it could not be read.
+    """
+    result = get_metadata(service, spreadsheet_id)
+    if result is None:
+        return None
+    return result.get("properties").get("title")
+
+
+def group_blocks(data, max_bytes=WRITE_BLOCK_BYTES):
+    """
+    Packs batchUpdate entries into requests of about `max_bytes` each.
+
+    Small entries, such as headers and changed rows, share a request, while an entry
+    from `chunk_rows` that is already near the limit gets one of its own.
+
+    Args:
+        data (list): The `data` entries to write.
+        max_bytes (int): The estimated size a request may grow to.
+
+    Returns:
+        list: The entries grouped into one list per request.
+    """
+    groups = []
+    group = []
+    size = 0
+    for entry in data:
+        cost = len(entry["range"]) + sum(row_bytes(row) for row in entry["values"])
+        if group and size + cost > max_bytes:
+            groups.append(group)
+            group, size = [], 0
+        group.append(entry)
+        size += cost
+    if group:
+        groups.append(group)
+    return groups
+
+
+def write_blocks(service, spreadsheet_id, data, value_input_option):
+    """
+    Writes ranges of a spreadsheet in size-limited values.batchUpdate requests.
+
+    The entries are grouped into requests of about WRITE_BLOCK_BYTES, which run
+    WRITE_WORKERS at a time under the Sheets write limiter. Each request is retried on
+    its own, so a failed block doesn't send the others again.
+
+    Args:
+        service (googleapiclient.discovery.Resource): An authenticated Google Sheets
+        API service object, used when everything fits in one request.
+        spreadsheet_id (str): The ID of the Google Sheets spreadsheet.
+        data (list): The ranges to write, each a dict with "range" and "values", as
+        built by `chunk_rows`.
         value_input_option (str): How the input data should be interpreted.
-        _values (List[List[Any]]): The new values to be written into the specified range.
 
     Returns:
-        dict: A dictionary containing the result of the update operation if successful,
-        or an error message if an exception occurred.
+        dict: The total rows written as "totalUpdatedRows" if every block was written,
+        or None if any of them failed.
     """
-    if count >= 3:
-        print("Hit max retries for update_values, returning None")
+    groups = group_blocks(data)
+
+    def write_block(group, block_service=None):
+        try:
+            return execute(
+                (block_service or thread_service("sheets", "v4"))
+                .spreadsheets()
+                .values()
+                .batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body={"valueInputOption": value_input_option, "data": group},
+                ),
+                SHEETS_WRITE,
+                "write_block",
+            )
+        except HttpError as error:
+            print(f"An error occurred in write_block: {error}")
+            return None
+
+    if len(groups) == 1:
+        results = [write_block(groups[0], service)]
+    else:
+        executor = worker_pool("write", WRITE_WORKERS)
+        results = list(executor.map(carry_labels(write_block), groups))
+    failed = results.count(None)
+    rows = sum(result.get("totalUpdatedRows", 0) for result in results if result)
+    if failed:
+        print(f"{rows} rows written, {failed} of {len(groups)} blocks failed.")
         return None
+    print(f"{rows} rows written in {len(groups)} request(s).")
+    return {"totalUpdatedRows": rows}
+
+
+def batch_get_values(service, spreadsheet_id, ranges):
+    """
+    Reads several ranges of a Google Sheets spreadsheet in one values.batchGet call.
+
+    Args:
+        service (googleapiclient.discovery.Resource): An authenticated Google Sheets
+        API service object.
+        spreadsheet_id (str): The ID of the Google Sheets spreadsheet.
+        ranges (list): The ranges to read.
+
+    Returns:
+        list or None: The values of each range, in the same order as `ranges`, or None if
+        the read failed.
+    """
     try:
-        body = {
-            "values": _values,
-        }
-        result = (
+        result = execute(
             service.spreadsheets()
             .values()
-            .update(
-                spreadsheetId=spreadsheet_id,
-                range=range_name,
-                valueInputOption=value_input_option,
-                body=body,
-            )
-            .execute()
+            .batchGet(spreadsheetId=spreadsheet_id, ranges=ranges),
+            SHEETS_READ,
+            "batch_get_values",
         )
-        print(f"{result.get('updatedRows')-1} rows updated.")
-        return result
+        return [
+            value_range.get("values", [])
+            for value_range in result.get("valueRanges", [])
+        ]
     except HttpError as error:
-        print(f"An error occurred in update_values: {error}")
-        update_values(
-            service, spreadsheet_id, range_name, value_input_option, _values, count + 1
-        )
+        print(f"An error occurred in batch_get_values: {error}")
+        return None
 
 
-def read_sheet(spreadsheet_id, range_name, sheets_service, count=0):
+def batch_update_spreadsheet(service, spreadsheet_id, requests):
     """
-    Reads the values from a specific range of a Google Sheets spreadsheet.
+    Sends several structural requests to a spreadsheet in one spreadsheets.batchUpdate.
 
     Args:
+        service (googleapiclient.discovery.Resource): An authenticated Google Sheets
+        API service object.
         spreadsheet_id (str): The ID of the Google Sheets spreadsheet.
-        range_name (str): The range of cells to read.
-        sheets_service (googleapiclient.discovery.Resource): An authenticated Google
-        Sheets API service object.
+        requests (list): The batchUpdate requests, such as addSheet or updateCells.
 
     Returns:
-        list: A list of lists containing the values in the specified range. If an error
-        occurs, it returns the error message.
+        dict or None: The batchUpdate response, or None if it failed.
     """
-    if count >= 3:
-        print("Hit max retries for read_sheet, returning None")
-        return None
     try:
-        sheet = sheets_service.spreadsheets()
-        result = (
-            sheet.values().get(spreadsheetId=spreadsheet_id, range=range_name).execute()
+        return execute(
+            service.spreadsheets().batchUpdate(
+                spreadsheetId=spreadsheet_id, body={"requests": requests}
+            ),
+            SHEETS_WRITE,
+            "batch_update_spreadsheet",
         )
-        values = result.get("values", [])
-        return values
     except HttpError as error:
-        print(f"An error occurred in read_sheet: {error}")
-        read_sheet(spreadsheet_id, range_name, sheets_service, count + 1)
+        print(f"An error occurred in batch_update_spreadsheet: {error}")
+        return None
 
 
-def get_sheets(service, spreadsheet_id, count=0):
+def get_sheets(service, spreadsheet_id):
     """
     Retrieves the sheets of a Google Sheets spreadsheet using the provided service and
     spreadsheet ID.
@@ -149,22 +380,14 @@ def get_sheets(service, spreadsheet_id, count=0):
         spreadsheet_id (str): The ID of the Google Sheets spreadsheet.
 
     Returns:
-        dict: A dictionary containing the sheets of the spreadsheet if successful, or an
-        error message if an exception occurred.
+        dict: A dictionary containing the sheets of the spreadsheet if successful, or None
+        if it could not be read.
     """
-    if count >= 3:
-        print("Hit max retries for get_sheets, returning None")
-        return None
-    try:
-        result = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-        return result
-    except HttpError as error:
-        print(f"An error occurred in get_sheets: {error}")
-        get_sheets(service, spreadsheet_id, count + 1)
+    return get_metadata(service, spreadsheet_id)
 
 
 def copy_spreadsheet(
-    source_spreadsheet_id, new_spreadsheet_title, service, dest_shared_drive_id, count=0
+    source_spreadsheet_id, new_spreadsheet_title, service, dest_shared_drive_id
 ):
     """Copies an existing spreadsheet to a new one with the specified title.
 
@@ -176,9 +399,6 @@ def copy_spreadsheet(
     Returns:
         The ID of the newly created spreadsheet if successful, None otherwise.
     """
-    if count >= 3:
-        print("Hit max retries for copy_spreadsheet, returning None")
-        return None
     try:
         copied_file = {"name": new_spreadsheet_title}
 
@@ -187,124 +407,132 @@ def copy_spreadsheet(
             copied_file["parents"] = [dest_shared_drive_id]
 
         # Copy the spreadsheet
-        new_sheet = (
-            service.files()
-            .copy(
+        new_sheet = execute(
+            service.files().copy(
                 fileId=source_spreadsheet_id,
                 body=copied_file,
                 supportsAllDrives=True,  # Important for shared drive support
-            )
-            .execute()
+            ),
+            DRIVE,
+            "copy_spreadsheet",
         )
+        if dest_shared_drive_id:
+            add_to_folder_index(
+                dest_shared_drive_id, new_spreadsheet_title, new_sheet["id"]
+            )
         return new_sheet["id"]
 
     except HttpError as error:
         print(f"An error occurred in copy_spreadsheet: {error}")
-        copy_spreadsheet(
-            source_spreadsheet_id,
-            new_spreadsheet_title,
-            service,
-            dest_shared_drive_id,
-            count + 1,
-        )
+        return None
 
 
-def clear_sheet(service, spreadsheet_id, sheet_name, count=0):
+def delta_data(sheet_name, current, tvalues, columns):
     """
-    Clears the cells of a specified sheet in a Google Sheets spreadsheet.
+    Builds the values.batchUpdate ranges that turn a sheet's current values into `tvalues`.
 
     Args:
-        service (googleapiclient.discovery.Resource): An authenticated Google Sheets API
-        service object.
-        spreadsheet_id (str): The ID of the Google Sheets spreadsheet.
-        sheet_name (str): The name of the sheet within the spreadsheet.
-
+        sheet_name (str): The name of the sheet.
+        current (list): The values currently in the sheet, header row first.
+        tvalues (list): The values for the sheet, header row first.
+        columns (list): The columns corresponding to the values.
+    
     Returns:
-        dict: A dictionary containing the result of the clear operation if successful, or
-        an error message if an exception occurred.
+        list or None: The header range followed by the changed row ranges, or None if the
+        sheet needs a full rewrite.
     """
-    if count >= 3:
-        print("Hit max retries for clear_sheet, returning None")
+    if current and current[0][: len(columns)] != list(columns):
         return None
-    try:
-        result = (
-            service.spreadsheets()
-            .values()
-            .clear(spreadsheetId=spreadsheet_id, range=sheet_name)
-            .execute()
-        )
-        print(f"{sheet_name} cells cleared.")
-        return result
-    except HttpError as error:
-        print(f"An error occurred in clear_sheet: {error}")
-        clear_sheet(service, spreadsheet_id, sheet_name, count + 1)
-
+    width = max([len(row) for row in current[1:]] + [len(columns)])
+    changes = diff_rows(current[1:], tvalues[1:], width)
+    header = chunk_rows(sheet_name, 1, tvalues[:1])
+    return header + delta_ranges(sheet_name, changes)
 
-def ensure_sheet_exists(spreadsheet_id, sheet_name, service, count=0):
-    """Checks if a sheet exists and creates it if not found.
-
-    Args:
-        spreadsheet_id: The ID of the Google Sheets spreadsheet.
-        sheet_name: The name of the sheet to check/create.
-        service: The authenticated Google Sheets API service object.
 
-    Returns:
-        The sheet ID if the sheet exists or was created, None otherwise.
+def update_spreadsheet(service, spreadsheet_id, tabs, has_header):
     """
-    if count >= 3:
-        print("Hit max retries for ensure_sheet_exists, returning None")
-        return None
-    sheets = get_sheets(service, spreadsheet_id).get("sheets", [])
-    existing_sheet_names = [sheet["properties"]["title"] for sheet in sheets]
-
-    if sheet_name in existing_sheet_names:
-        sheet_id = next(
-            (
-                sheet["properties"]["sheetId"]
-                for sheet in sheets
-                if sheet["properties"]["title"] == sheet_name
-            ),
-            None,
-        )
-        return sheet_id
+    Updates several tabs of one spreadsheet with as few requests as possible.
 
-    try:
-        request_body = {
-            "requests": [{"addSheet": {"properties": {"title": sheet_name}}}]
-        }
-        response = (
-            service.spreadsheets()
-            .batchUpdate(spreadsheetId=spreadsheet_id, body=request_body)
-            .execute()
-        )
-
-        sheet_id = response["replies"][0]["addSheet"]["properties"]["sheetId"]
-        return sheet_id
-
-    except HttpError as error:
-        print(f"An error occurred in ensure_sheet_exists: {error}")
-        ensure_sheet_exists(spreadsheet_id, sheet_name, service, count + 1)
-
-
-def update_sheet(service, sheet_id, sheet_name, values, columns, has_header):
-    """
-    Updates the specified Google Sheets with the provided values and columns.
+    Missing tabs are added and tabs that need a full rewrite are cleared in a single
+    spreadsheets.batchUpdate, and the data for every tab goes out through `write_blocks`,
+    in as few size-limited values.batchUpdate requests as it fits in. Tabs with key
+    columns are diffed against their current values, read with one values.batchGet,
+    and only their changed rows are written. Values are written RAW, so Sheets stores
+    them exactly as given and reads them back the same way, instead of re-parsing
+    leading zeros, dates or times into values that never match on the next diff.
 
     Args:
-        sheet_id (str): The ID of the Google Sheet to update.
-        sheet_name (str): The name of the sheet within the Google Sheet.
-        values (list): The values to update in the sheet.
-        columns (list): The columns corresponding to the values.
+        service (googleapiclient.discovery.Resource): An authenticated Google Sheets
+        API service object.
+        spreadsheet_id (str): The ID of the Google Sheets spreadsheet.
+        tabs (list): One dict per tab with "sheetName", "values", "columns" and
+        optionally "keyColumns".
+        has_header (bool): Whether each tab's values already start with a header row.
 
     Returns:
-        None
+        bool: True if every tab was written, False if a request failed.
     """
-    ensure_sheet_exists(sheet_id, sheet_name, service)
-    clear_sheet(service, sheet_id, sheet_name)
-    if not has_header:
-        tvalues = add_header(values, columns)
-    else:
-        tvalues = values
-    update_values(
-        service, sheet_id, create_range(values, sheet_name), "USER_ENTERED", tvalues
-    )
+    spreadsheet = get_sheets(service, spreadsheet_id)
+    if spreadsheet is None:
+        return False
+    sheet_ids = {
+        sheet["properties"]["title"]: sheet["properties"]["sheetId"]
+        for sheet in spreadsheet.get("sheets", [])
+    }
+
+    delta_names = [
+        tab.get("sheetName")
+        for tab in tabs
+        if tab.get("keyColumns") and tab.get("sheetName") in sheet_ids
+    ]
+    current = {}
+    if delta_names:
+        ranges = batch_get_values(
+            service, spreadsheet_id, [f"'{name}'" for name in delta_names]
+        )
+        if ranges is not None:
+            current = dict(zip(delta_names, ranges))
+
+    requests = []
+    data = []
+    for tab in tabs:
+        sheet_name = tab.get("sheetName")
+        if has_header:
+            tvalues = tab.get("values")
+        else:
+            tvalues = add_header(tab.get("values"), tab.get("columns"))
+        if sheet_name not in sheet_ids:
+            requests.append({"addSheet": {"properties": {"title": sheet_name}}})
+        else:
+            if sheet_name in current:
+                delta = delta_data(
+                    sheet_name,
+                    current[sheet_name],
+                    tvalues,
+                    tab.get("columns"),
+                )
+                if delta is not None:
+                    data.extend(delta)
+                    continue
+            requests.append(
+                {
+                    "updateCells": {
+                        "range": {"sheetId": sheet_ids[sheet_name]},
+                        "fields": "userEnteredValue",
+                    }
+                }
+            )
+        data.extend(chunk_rows(sheet_name, 1, tvalues))
+
+    if requests:
+        response = batch_update_spreadsheet(service, spreadsheet_id, requests)
+        if response is None or any("addSheet" in request for request in requests):
+            # A failed request may mean the cached tabs are out of date, such as a tab
+            # deleted by hand, so they are read again next time.
+            invalidate_metadata(spreadsheet_id)
+        if response is None:
+            return False
+    if data:
+        result = write_blocks(service, spreadsheet_id, data, "RAW")
+        return result is not None
+    return True
@@ -0,0 +1,230 @@
+"""
+This module keeps a local SQLite snapshot of the rows api_writer pulls.
+
+The snapshot answers lookups during an outage, when the spreadsheets can't be opened.
+Every QUERIES entry gets a table holding its columns plus the building column, indexed
+on the columns SNAPSHOT_LOOKUPS searches. Each run replaces the rows of the buildings it
+fetched in one transaction, so the database always holds the last complete pull.
+
+It can also be run to look rows up without any network access:
+
+    python snapshot.py student 123456
+    python snapshot.py student "Smith, J"
+    python snapshot.py bus 14 --school 1150
+    python snapshot.py info
+"""
+
+import argparse
+import re
+import sqlite3
+import time
+from constants import QUERIES, SCHOOL_COLUMN, SNAPSHOT_FILE, SNAPSHOT_LOOKUPS
+
+
+def table_name(query):
+    """Return the snapshot table name for a query, such as transportation_info."""
+    return re.sub(r"[^a-z0-9]+", "_", query.get("sheetName").lower()).strip("_")
+
+
+def table_columns(query):
+    """Return the columns of a query's snapshot table, building column last."""
+    return query.get("columns") + [SCHOOL_COLUMN]
+
+
+def quote(name):
+    """Return a column or table name quoted for SQL."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def open_snapshot(path=SNAPSHOT_FILE):
+    """
+    Opens the snapshot database, creating it if needed.
+
+    Args:
+        path (str): The path of the database file.
+
+    Returns:
+        sqlite3.Connection: The connection. It may be handed to another thread, but only
+        one thread should use it at a time.
+    """
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS snapshot_updates ("
+        "table_name TEXT, schoolid TEXT, updated TEXT, row_count INTEGER, "
+        "PRIMARY KEY (table_name, schoolid))"
+    )
+    return connection
+
+
+def ensure_table(connection, query):
+    """
+    Creates the table and indexes for a query, rebuilding them if its columns changed.
+
+    Args:
+        connection (sqlite3.Connection): The snapshot database.
+        query (dict): The query entry from QUERIES.
+    """
+    name = table_name(query)
+    columns = table_columns(query)
+    existing = [
+        row[1] for row in connection.execute(f"PRAGMA table_info({quote(name)})")
+    ]
+    if existing and existing != columns:
+        connection.execute(f"DROP TABLE {quote(name)}")
+        connection.execute(
+            "DELETE FROM snapshot_updates WHERE table_name = ?", (name,)
+        )
+    definitions = ", ".join(
+        f"{quote(column)} TEXT COLLATE NOCASE" for column in columns
+    )
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {quote(name)} ({definitions})")
+    indexed = {SCHOOL_COLUMN}
+    for lookup_columns in SNAPSHOT_LOOKUPS.values():
+        indexed.update(column for column in lookup_columns if column in columns)
+    for column in sorted(indexed):
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {quote(name + '_' + column)} "
+            f"ON {quote(name)} ({quote(column)})"
+        )
+
+
+def write_rows(connection, query, rows, schoolid=None):
+    """
+    Replaces the snapshot rows for a query in a single transaction.
+
+    Args:
+        connection (sqlite3.Connection): The snapshot database.
+        query (dict): The query entry from QUERIES.
+        rows (list): The rows from `make_list`.
+        schoolid (int, optional): The building the rows belong to. Only that building's
+        rows are replaced. If None, the rows end with their building, as `make_list`
+        builds them for a district fetch, and the whole table is replaced.
+
+    Returns:
+        bool: True if the rows were written, False if the transaction was rolled back.
+    """
+    name = table_name(query)
+    columns = table_columns(query)
+    placeholders = ", ".join("?" * len(columns))
+    insert = f"INSERT INTO {quote(name)} VALUES ({placeholders})"
+    try:
+        with connection:
+            ensure_table(connection, query)
+            if schoolid is None:
+                connection.execute(f"DELETE FROM {quote(name)}")
+                connection.executemany(insert, rows)
+                connection.execute(
+                    "DELETE FROM snapshot_updates WHERE table_name = ?", (name,)
+                )
+            else:
+                connection.execute(
+                    f"DELETE FROM {quote(name)} WHERE {quote(SCHOOL_COLUMN)} = ?",
+                    (str(schoolid),),
+                )
+                connection.executemany(
+                    insert, (tuple(row) + (schoolid,) for row in rows)
+                )
+            connection.execute(
+                "INSERT OR REPLACE INTO snapshot_updates VALUES (?, ?, ?, ?)",
+                (
+                    name,
+                    "all" if schoolid is None else str(schoolid),
+                    time.strftime("%m-%d-%Y %I:%M %p"),
+                    len(rows),
+                ),
+            )
+        return True
+    except sqlite3.Error as error:
+        print(f"An error occurred in write_rows: {error}")
+        return False
+
+
+def lookup(connection, kind, value, school=None):
+    """
+    Finds the rows whose SNAPSHOT_LOOKUPS columns for `kind` match a value.
+
+    Numbers must match exactly, so bus 14 doesn't find bus 140. Anything else matches
+    the start of the value, ignoring case, so "smith" finds every Smith.
+
+    Args:
+        connection (sqlite3.Connection): The snapshot database.
+        kind (str): A key of SNAPSHOT_LOOKUPS, such as "student" or "bus".
+        value (str): The value to look for.
+        school (str, optional): Only return rows for this building.
+
+    Returns:
+        list: (query, rows) pairs for each table with matches.
+    """
+    if value.isdigit():
+        operator, argument = "=", value
+    else:
+        operator, argument = "LIKE", value.replace("%", "").replace("_", "") + "%"
+    results = []
+    existing = {
+        row[0]
+        for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )
+    }
+    for query in QUERIES:
+        name = table_name(query)
+        columns = [
+            column
+            for column in SNAPSHOT_LOOKUPS[kind]
+            if column in query.get("columns")
+        ]
+        if name not in existing or not columns:
+            continue
+        where = " OR ".join(f"{quote(column)} {operator} ?" for column in columns)
+        parameters = [argument] * len(columns)
+        if school is not None:
+            where = f"({where}) AND {quote(SCHOOL_COLUMN)} = ?"
+            parameters.append(school)
+        rows = connection.execute(
+            f"SELECT * FROM {quote(name)} WHERE {where}", parameters
+        ).fetchall()
+        if rows:
+            results.append((query, rows))
+    return results
+
+
+def print_results(results):
+    """Print lookup results, one block per row with its non-empty values."""
+    for query, rows in results:
+        print(f"== {query.get('sheetName')} ({len(rows)}) ==")
+        for row in rows:
+            for column, value in zip(table_columns(query), row):
+                if value not in (None, ""):
+                    print(f"  {column}: {value}")
+            print()
+
+
+def main():
+    """Answer a lookup from the command line."""
+    parser = argparse.ArgumentParser(description="Look up rows in the local snapshot.")
+    parser.add_argument("kind", choices=sorted(SNAPSHOT_LOOKUPS) + ["info"])
+    parser.add_argument("value", nargs="?", help="What to look for.")
+    parser.add_argument("--school", help="Only show rows for this school ID.")
+    parser.add_argument("--db", default=SNAPSHOT_FILE, help="The snapshot database.")
+    args = parser.parse_args()
+
+    connection = open_snapshot(args.db)
+    if args.kind == "info":
+        for row in connection.execute(
+            "SELECT * FROM snapshot_updates ORDER BY table_name, schoolid"
+        ):
+            print(f"{row[0]}  school {row[1]}  {row[3]} rows  updated {row[2]}")
+        return
+    if not args.value:
+        parser.error(f"{args.kind} needs a value to look for")
+    start = time.perf_counter()
+    results = lookup(connection, args.kind, args.value, args.school)
+    elapsed = (time.perf_counter() - start) * 1000
+    print_results(results)
+    print(f"{sum(len(rows) for _, rows in results)} rows in {elapsed:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
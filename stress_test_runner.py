@@ -1,13 +1,32 @@
 """
 This module contains functions for running stress tests on scripts.
 
-It provides a function `run_stress_test` that executes a given script 
-multiple times and logs the results.
+It provides a function `run_stress_test` that executes a given script many times,
+optionally several copies at once so they contend for the same API quota, and logs the
+results. The duration percentiles and failure rate of a test can be saved as a baseline
+and later tests compared against it, flagging any percentile that got worse by more
+than a threshold. Each of the concurrent slots runs in a scratch directory of its own,
+with a copy of the credential files, so the runs never share a journal or manifest.
+
+Example:
+    python stress_test_runner.py api_writer.py --iterations 20 --concurrency 4 --warmup 2
+    python stress_test_runner.py copy_files.py --fake --save-baseline
+    python stress_test_runner.py some_script.py --iterations 5 -- --its-own-flag
 """
 
+import argparse
+import contextlib
+import json
+import logging
+import os
+import shutil
 import subprocess
+import sys
+import tempfile
 import time
-import logging
+from concurrent.futures import ThreadPoolExecutor
+from constants import STRESS_BASELINE_FILE, STRESS_REGRESSION_THRESHOLD, PS_TOKEN_FILE
+from journal import BUSY_EXIT
 
 # Configure logging
 logging.basicConfig(
@@ -16,49 +35,363 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
 )
 
+# The duration percentiles reported and compared to the baseline.
+PERCENTILES = (50, 95, 99)
+
+# The credential files each slot's scratch directory gets a copy of. They are copied
+# rather than linked because token.json is rewritten whenever it is refreshed.
+SLOT_FILES = ("token.json", "credentials.json", PS_TOKEN_FILE)
+
 
-def run_stress_test(script, itera, n):
+def run_once(script, label, args=(), cwd=None, env=None, timeout=None):
+    """
+    Runs the script once and logs how it went.
+
+    Args:
+        script (str): The path to the script to be executed.
+        label (str): How the run is named in the log, such as "Iteration 3".
+        args (list): Extra arguments to pass to the script.
+        cwd (str, optional): The directory to run the script in.
+        env (dict, optional): The environment for the script.
+        timeout (float, optional): Seconds after which the run is stopped and failed.
+
+    Returns:
+        dict: The run's duration in seconds, whether it succeeded, and whether it
+        failed because another run held its journal.
+    """
+    start_time = time.perf_counter()
+    try:
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(script), *args],
+            cwd=cwd,
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+        duration = time.perf_counter() - start_time
+        logging.info(
+            "%s: Success - Duration: %.4f seconds - Output: %s",
+            label,
+            duration,
+            result.stdout.strip()[-500:],
+        )
+        return {"seconds": duration, "ok": True, "busy": False}
+    except subprocess.CalledProcessError as e:
+        error = e.stderr.strip()[-500:]
+        busy = e.returncode == BUSY_EXIT
+    except subprocess.TimeoutExpired:
+        error = f"Timed out after {timeout} seconds"
+        busy = False
+    duration = time.perf_counter() - start_time
+    logging.error(
+        "%s: Failure - Duration: %.4f seconds - Error: %s", label, duration, error
+    )
+    return {"seconds": duration, "ok": False, "busy": busy}
+
+
+def run_stress_test(
+    script,
+    itera,
+    concurrency=1,
+    warmup=0,
+    args=(),
+    workdirs=None,
+    env=None,
+    timeout=None,
+):
     """
     Run the stress test by executing the given script multiple times.
 
+    The runs are split across `concurrency` slots that go at the same time. Each slot
+    runs its share one after the other, in its own directory if `workdirs` gives one,
+    so runs going at the same time contend for the APIs rather than for the same
+    manifest, journal and token files. Warmup runs go first in every slot and are left
+    out of the results so caches, tokens and the manifest are in their usual state
+    before anything is measured.
+
     Args:
         script (str): The path to the script to be executed.
         itera (int): The number of times to run the script.
-        n (int): The argument to pass to the script.
+        concurrency (int): The number of runs going at the same time.
+        warmup (int): The number of unmeasured runs made first in each slot.
+        args (list): Extra arguments to pass to the script.
+        workdirs (list, optional): The directory of each slot. Every run uses the
+        current directory if None.
+        env (dict, optional): The environment for the script.
+        timeout (float, optional): Seconds after which a run is stopped and failed.
+
+    Returns:
+        list: The duration and outcome of each measured run.
+    """
+    slots = max(1, concurrency)
+    workdirs = workdirs or [None] * slots
+
+    def options(slot):
+        return args, workdirs[slot], env, timeout
+
+    def warm_slot(slot):
+        for i in range(warmup):
+            run_once(script, f"Warmup {i + 1} (slot {slot + 1})", *options(slot))
+
+    def run_slot(slot):
+        return [
+            (i, run_once(script, f"Iteration {i + 1}", *options(slot)))
+            for i in range(slot, itera, slots)
+        ]
+
+    with ThreadPoolExecutor(max_workers=slots) as executor:
+        list(executor.map(warm_slot, range(slots)))
+        runs = [run for slot in executor.map(run_slot, range(slots)) for run in slot]
+    return [result for _, result in sorted(runs, key=lambda run: run[0])]
+
+
+def percentile(values, pct):
+    """
+    Returns a percentile of some values, interpolating between the closest two.
+
+    Args:
+        values (list): The values, in any order.
+        pct (float): The percentile, from 0 to 100.
+
+    Returns:
+        float: The percentile, or None if there are no values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(results):
+    """
+    Returns the duration percentiles and failure rate of a stress test.
+
+    Percentiles are taken over the successful runs, since a run that fails early would
+    make the script look faster than it is.
+
+    Args:
+        results (list): The runs from `run_stress_test`.
+
+    Returns:
+        dict: The run and failure counts, the number of failures that found their
+        journal busy, the failure rate and p50, p95 and p99.
+    """
+    durations = [result["seconds"] for result in results if result["ok"]]
+    failures = len(results) - len(durations)
+    stats = {
+        "runs": len(results),
+        "failures": failures,
+        "busy": sum(1 for result in results if result.get("busy")),
+        "failure_rate": failures / len(results) if results else 0.0,
+    }
+    for pct in PERCENTILES:
+        stats[f"p{pct}"] = percentile(durations, pct)
+    return stats
+
+
+def baseline_key(script, concurrency):
+    """Return the key a test's baseline is stored under, such as "api_writer.py x4"."""
+    return f"{os.path.basename(script)} x{concurrency}"
+
+
+def load_baselines(path=STRESS_BASELINE_FILE):
+    """
+    Loads the saved baselines.
+
+    Args:
+        path (str): The baseline file.
+
+    Returns:
+        dict: The baselines keyed by `baseline_key`, empty if the file doesn't exist.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as error:
+        print(f"An error occurred in load_baselines: {error}")
+        return {}
+
+
+def save_baseline(key, stats, path=STRESS_BASELINE_FILE):
+    """
+    Saves a test's results as the baseline for its script and concurrency.
+
+    Args:
+        key (str): The key from `baseline_key`.
+        stats (dict): The results from `summarize`.
+        path (str): The baseline file.
+    """
+    baselines = load_baselines(path)
+    baselines[key] = dict(stats, saved=time.strftime("%m-%d-%Y %I:%M %p"))
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(baselines, file, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def compare(stats, baseline, threshold=STRESS_REGRESSION_THRESHOLD):
+    """
+    Compares a test's percentiles to its baseline.
+
+    Args:
+        stats (dict): The results from `summarize`.
+        baseline (dict): The saved results to compare to.
+        threshold (float): How much worse, as a fraction, a percentile may get.
 
     Returns:
-        None
-    """
-    for i in range(itera):
-        start_time = time.time()
-        try:
-            result = subprocess.run(
-                ["python", script, str(n)],
-                check=True,
-                capture_output=True,
-                text=True,
-            )
-            end_time = time.time()
-            duration = end_time - start_time
-            logging.info(
-                "Iteration %d: Success - Duration: %.4f seconds - Output: %s",
-                i + 1,
-                duration,
-                result.stdout.strip(),
-            )
-        except subprocess.CalledProcessError as e:
-            end_time = time.time()
-            duration = end_time - start_time
-            logging.error(
-                "Iteration %d: Failure - Duration: %.4f seconds - Error: %s",
-                i + 1,
-                duration,
-                e.stderr.strip(),
-            )
+        list: The regressions, as (name, baseline, current, change) tuples.
+    """
+    regressions = []
+    for pct in PERCENTILES:
+        name = f"p{pct}"
+        before, after = baseline.get(name), stats.get(name)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        if change > threshold:
+            regressions.append((name, before, after, change))
+    return regressions
+
+
+def print_summary(key, stats, baseline=None):
+    """Print a test's results, next to its baseline if there is one."""
+    baseline = baseline or {}
+    print(f"{key}: {stats['runs']} runs, {stats['failures']} failed")
+    for pct in PERCENTILES:
+        name = f"p{pct}"
+        value, before = stats[name], baseline.get(name)
+        if value is None:
+            print(f"  {name:<4} no successful runs")
+            continue
+        line = f"  {name:<4} {value:.3f}s"
+        if before:
+            line += f"  (baseline {before:.3f}s, {(value - before) / before:+.1%})"
+        print(line)
+    line = f"  failure rate {stats['failure_rate']:.1%}"
+    if "failure_rate" in baseline:
+        line += f"  (baseline {baseline['failure_rate']:.1%})"
+    print(line)
+
+
+def slot_directory(stack, credentials=True):
+    """
+    Makes a scratch directory for one slot of a stress test.
+
+    Args:
+        stack (contextlib.ExitStack): The stack the directory is removed with.
+        credentials (bool): Whether to copy the SLOT_FILES there are into it.
+
+    Returns:
+        str: The path of the directory.
+    """
+    workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix="ps-stress-"))
+    if credentials:
+        for name in SLOT_FILES:
+            if os.path.exists(name):
+                shutil.copy2(name, workdir)
+    return workdir
+
+
+def main():
+    """Run a stress test from the command line and compare it to its baseline."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("script", nargs="?", default="api_writer.py")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="Runs going at the same time."
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=1, help="Unmeasured runs first, in each slot."
+    )
+    parser.add_argument("--timeout", type=float, help="Seconds before a run fails.")
+    parser.add_argument("--baseline", default=STRESS_BASELINE_FILE)
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="Store this test as the baseline."
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=STRESS_REGRESSION_THRESHOLD,
+        help="How much worse, as a fraction, a percentile may get. 0.2 is 20%%.",
+    )
+    parser.add_argument(
+        "--fake",
+        action="store_true",
+        help="Run against the stand-ins in fake_services.py.",
+    )
+    parser.add_argument("--students", type=int, default=2000, help="With --fake.")
+    # Anything after "--" is passed on to the script.
+    argv = sys.argv[1:]
+    script_args = argv[argv.index("--") + 1 :] if "--" in argv else []
+    args = parser.parse_args(argv[: len(argv) - len(script_args)])
+
+    with contextlib.ExitStack() as stack:
+        # Every slot runs in a scratch directory of its own, so concurrent runs don't
+        # share a journal, manifest or snapshot.
+        workdirs = [
+            slot_directory(stack, credentials=not args.fake)
+            for _ in range(max(1, args.concurrency))
+        ]
+        env = None
+        if args.fake:
+            # pylint: disable=import-outside-toplevel
+            from benchmark import stand_in_env
+            from fake_services import FakePowerSchool, FakeGoogle
+
+            services = {
+                "powerschool": FakePowerSchool(students=args.students).start(),
+                "google": FakeGoogle().start(),
+            }
+            for service in services.values():
+                stack.callback(service.stop)
+            env = stand_in_env(services)
+        results = run_stress_test(
+            args.script,
+            args.iterations,
+            concurrency=args.concurrency,
+            warmup=args.warmup,
+            args=script_args,
+            workdirs=workdirs,
+            env=env,
+            timeout=args.timeout,
+        )
+
+    key = baseline_key(args.script, args.concurrency)
+    stats = summarize(results)
+    baseline = load_baselines(args.baseline).get(key)
+    print_summary(key, stats, baseline)
+    logging.info("%s: %s", key, json.dumps(stats))
+    if stats["busy"]:
+        message = (
+            f"{stats['busy']} runs stopped because another run held their journal, so "
+            "the runs collided instead of being measured."
+        )
+        print(message)
+        logging.error("%s: %s", key, message)
+        return 1
+    if args.save_baseline:
+        save_baseline(key, stats, args.baseline)
+        print(f"Saved as the baseline for {key} in {args.baseline}.")
+        return 0
+    if baseline is None:
+        print(f"No baseline for {key} yet. Run with --save-baseline to store one.")
+        return 0
+    regressions = compare(stats, baseline, args.threshold)
+    for name, before, after, change in regressions:
+        message = (
+            f"Regression: {name} went from {before:.3f}s to {after:.3f}s "
+            f"({change:+.1%}, threshold {args.threshold:.0%})"
+        )
+        print(message)
+        logging.warning("%s: %s", key, message)
+    return 1 if regressions else 0
 
 
 if __name__ == "__main__":
-    SCRIPT_NAME = "api_writer.py"
-    ITERATIONS = 10  # Number of times to run the script
-    ARGUMENTS = 10000  # Argument to pass to the script (modify as needed)
-    run_stress_test(SCRIPT_NAME, ITERATIONS, ARGUMENTS)
+    sys.exit(main())